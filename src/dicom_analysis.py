@@ -8,19 +8,40 @@
 # Purpose :
 #
 # How to Run :
-#   python src/dicom_analysis.py path [series|single|pickle] stem
+#   python src/dicom_analysis.py path [series|single|pickle] stem s1,s2,...,sN [options]
+import os
 import sys
 import numpy as np
 import time
 import pydicom
-import pickle
 # my code
 from gaussian import gaussian_derivative_of_tensor
 from hessian import extract_local_shape
+from tiles import extract_local_shape_tiled
+from parallel import extract_local_shape_parallel
+from gaussian import set_num_threads
+from sigma_cache import evict_sigma_cache
+from sigma_cache import SIGMA_CACHE_MAX_BYTES
+from sigma_cache import SIGMA_CACHE_MAX_AGE
+from sigma_cache import volume_digest
+from results import write_results
+from results import RESULTS_SUFFIX
+from volume_cache import VOLUME_CACHE_MAX_BYTES
 from error import exit_with_error
 from error import warning
 from file_io import read_data
-    
+from functions import parse_options
+
+# Options and their defaults, also forwarded by batch.py
+ANALYSIS_OPTD = {'--dtype' : 'float32', '--method' : 'auto', '--slab' : None,
+                 '--workers' : None,
+                 '--threads' : None, '--stream' : 'no', '--masked' : 'no',
+                 '--crop' : 'no', '--pyramid' : 'no', '--scale-space' : 'no',
+                 '--cache' : None,
+                 '--cache-size' : None, '--cache-age' : None, '--readers' : None,
+                 '--volume-cache' : None, '--volume-cache-size' : None,
+                 '--quantize' : 'no', '--compress' : 'no'}
+
 
 def print_help(ExitVal=None):
     """
@@ -35,16 +56,54 @@ def print_help(ExitVal=None):
     FUTURE:
     """
     sys.stdout.write(
-        "\nUSAGE : python src/dicom_analysis.py path [series|single|pickle] stem s1,s2,...,sN\n\n"
+        "\nUSAGE : python src/dicom_analysis.py path [series|single|pickle] stem s1,s2,...,sN [options]\n\n"
         "      path            : string, path to either a DICOM file or a directory of DICOMs\n"
         "      [series|single|pickle] : string\n"
         "                               if 'series' : path is a directory with a series of DICOM files\n"
         "                               if 'single' : path is a single DICOM file\n"
         "                               if 'pickle' : path is a single pickle file generated by generate_test_data.py\n"
-        "      stem            : The output filename stem\n"
+        "      stem            : The output filename stem, results are written to stem.res\n"
         "      s1,s2,...,sN    : int (comma seperated). The list of sigmas controlling size of \n"
         "                        guassian kernel in derivative calculation\n"
-        "                         \n")
+        "   options :\n"
+        "      --dtype [float32|float64] : floating point type used by the analysis,\n"
+        "                                  default float32\n"
+        "      --method [fir|fft|iir|auto] : how the derivatives are convolved, the cost\n"
+        "                                  of fft and iir doesn't grow with sigma, iir is\n"
+        "                                  approximate, auto picks fft for long kernels,\n"
+        "                                  default auto\n"
+        "      --slab N                  : process the volume in slabs of N voxels (out of\n"
+        "                                  core)\n"
+        "      --workers N               : split the volume between N processes\n"
+        "      --stream [yes|no]         : if yes, memory doesn't grow with the number of\n"
+        "                                  sigmas, but the derivatives are done twice\n"
+        "      --masked [yes|no]         : if yes, skip the eigenvalues of the voxels below\n"
+        "                                  the mean density (they score 0 anyway)\n"
+        "      --crop [yes|no]           : if yes, only analyze the bounding box of the\n"
+        "                                  body (Otsu threshold), 0 outside of it\n"
+        "      --pyramid [yes|no]        : if yes, compute sigmas >= 4 on coarser grids\n"
+        "                                  (faster, approximate)\n"
+        "      --scale-space [yes|no]    : if yes, derive each sigma by blurring the\n"
+        "                                  previous one, all with the smallest sigma's\n"
+        "                                  kernels (a true gaussian scale space)\n"
+        "      --cache DIR               : keep the results of each sigma in DIR, rerunning\n"
+        "                                  with more sigmas only computes the new ones\n"
+        "      --cache-size GB           : size limit of the cache, least recently used\n"
+        "                                  sigmas are removed first, default {:g}\n"
+        "      --cache-age DAYS          : remove the sigmas not used for DAYS, default {:g}\n"
+        "      --quantize [no|8|16]      : store the measures as 8 or 16 bit fixed point and\n"
+        "                                  the sigma maps as indices into the sigmas\n"
+        "      --compress [yes|no]       : zlib compress the results file\n"
+        "      --volume-cache DIR        : keep the decoded series in DIR, later runs on\n"
+        "                                  the same files memory map it\n"
+        "      --volume-cache-size GB    : size limit of the volume cache, default {:g}\n"
+        "      --readers N               : threads reading a DICOM series, default the\n"
+        "                                  same as --threads\n"
+        "      --threads N               : threads used by the derivatives, default from\n"
+        "                                  OMP_NUM_THREADS or the number of cores\n"
+        "                         \n".format(SIGMA_CACHE_MAX_BYTES / 2**30,
+                                          SIGMA_CACHE_MAX_AGE / (24 * 3600.0),
+                                          VOLUME_CACHE_MAX_BYTES / 2**30))
     sys.exit(ExitVal)
 
 
@@ -65,29 +124,114 @@ def main():
                         "expected\n".format(sys.version_info[0]))
 
     ###### Get Command Line Options ######
-    if(len(sys.argv) != 2 and len(sys.argv) != 5) :
-        print_help(1)
-    elif(len(sys.argv) == 2 and "-h" in sys.argv[1]):
+    if(len(sys.argv) == 2 and "-h" in sys.argv[1]):
         print_help(0)
-    elif(len(sys.argv) != 5):
+    argL, optD = parse_options(ArgL=sys.argv, OptD=ANALYSIS_OPTD)
+    if(len(argL) != 5):
         print_help(1)
 
-    path = sys.argv[1]
-    if(sys.argv[2].lower() == "series"):
+    path = argL[1]
+    if(argL[2].lower() == "series"):
         inputFmt = "series"
-    elif(sys.argv[2].lower() == "single"):
+    elif(argL[2].lower() == "single"):
         inputFmt = "single"
-    elif(sys.argv[2].lower() == "pickle"):
+    elif(argL[2].lower() == "pickle"):
         inputFmt = "pickle"
     else:
         exit_with_error("ERROR!!! {} is invalid value for "
-                        "[series|single|pickle]\n".format(inputFmt))
-    stem = sys.argv[3]
-    string = sys.argv[4]
+                        "[series|single|pickle]\n".format(argL[2]))
+    if(optD['--dtype'] not in ['float32', 'float64']):
+        exit_with_error("ERROR!!! --dtype {} is invalid, float32 or float64 "
+                        "expected\n".format(optD['--dtype']))
+    dtype = np.dtype(optD['--dtype'])
+    if(optD['--method'] not in ['fir', 'fft', 'iir', 'auto']):
+        exit_with_error("ERROR!!! --method {} is invalid, fir, fft, iir or auto "
+                        "expected\n".format(optD['--method']))
+    method = optD['--method']
+    slab  = int(optD['--slab']) if optD['--slab'] is not None else None
+    workers = int(optD['--workers']) if optD['--workers'] is not None else None
+    if(slab is not None and workers is not None):
+        exit_with_error("ERROR!!! --slab and --workers can't be used together\n")
+    if(method == 'iir' and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --method iir can't be used with --slab or --workers, "
+                        "it has infinite support\n")
+    if(optD['--stream'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --stream {} is invalid, yes or no "
+                        "expected\n".format(optD['--stream']))
+    stream = (optD['--stream'] == 'yes')
+    if(stream == True and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --stream can't be used with --slab or --workers\n")
+    if(optD['--masked'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --masked {} is invalid, yes or no "
+                        "expected\n".format(optD['--masked']))
+    masked = (optD['--masked'] == 'yes')
+    if(masked == True and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --masked can't be used with --slab or --workers\n")
+    if(optD['--crop'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --crop {} is invalid, yes or no "
+                        "expected\n".format(optD['--crop']))
+    crop = (optD['--crop'] == 'yes')
+    if(crop == True and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --crop can't be used with --slab or --workers\n")
+    if(optD['--pyramid'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --pyramid {} is invalid, yes or no "
+                        "expected\n".format(optD['--pyramid']))
+    pyramid = (optD['--pyramid'] == 'yes')
+    if(pyramid == True and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --pyramid can't be used with --slab or --workers\n")
+    if(optD['--scale-space'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --scale-space {} is invalid, yes or no "
+                        "expected\n".format(optD['--scale-space']))
+    scaleSpace = (optD['--scale-space'] == 'yes')
+    if(scaleSpace == True and pyramid == True):
+        exit_with_error("ERROR!!! --scale-space and --pyramid can't be used together\n")
+    if(optD['--quantize'] not in ['no', '8', '16']):
+        exit_with_error("ERROR!!! --quantize {} is invalid, no, 8 or 16 "
+                        "expected\n".format(optD['--quantize']))
+    if(optD['--compress'] not in ['yes', 'no']):
+        exit_with_error("ERROR!!! --compress {} is invalid, yes or no "
+                        "expected\n".format(optD['--compress']))
+    compress = (optD['--compress'] == 'yes')
+    cache = optD['--cache']
+    if(cache is not None and (slab is not None or workers is not None)):
+        exit_with_error("ERROR!!! --cache can't be used with --slab or --workers\n")
+    cacheSize = SIGMA_CACHE_MAX_BYTES
+    if(optD['--cache-size'] is not None):
+        cacheSize = float(optD['--cache-size']) * 2**30
+    cacheAge  = SIGMA_CACHE_MAX_AGE
+    if(optD['--cache-age'] is not None):
+        cacheAge = float(optD['--cache-age']) * 24 * 3600.0
+    if(optD['--threads'] is not None):
+        set_num_threads(int(optD['--threads']))
+    stem = argL[3]
+    string = argL[4]
     strL   = string.split(",")
     sL     = [int(s) for s in strL]
     print("kernel widths (sigma) used : {}".format(sL))
-    pixelT = read_data(Path=path, NFiles=inputFmt)
+    readers = int(optD['--readers']) if optD['--readers'] is not None else None
+    volumeCacheSize = VOLUME_CACHE_MAX_BYTES
+    if(optD['--volume-cache-size'] is not None):
+        volumeCacheSize = float(optD['--volume-cache-size']) * 2**30
+    # Out of core, the input isn't read into memory either. A series is decoded
+    # into a .npy next to the results (the volume cache is already memory mapped)
+    inPath = None
+    if(slab is not None and optD['--volume-cache'] is None and inputFmt == "series"):
+        inPath = "{}_input.npy".format(stem)
+    metaD  = {}
+    pixelT = read_data(Path=path, NFiles=inputFmt, Workers=readers,
+                       Cache=optD['--volume-cache'], CacheSize=volumeCacheSize, MetaD=metaD,
+                       OutPath=inPath)
+    # Saved with the results, see results.py
+    runD   = {'sigmas' : sL, 'fingerprint' : volume_digest(DataT=pixelT),
+              'spacing' : metaD['spacing'], 'input' : os.path.abspath(path),
+              'format' : inputFmt, 'shape' : list(pixelT.shape), 'options' : optD}
+    outPath = "{}.{}".format(stem, RESULTS_SUFFIX)
+    encodeD = {}
+    if(optD['--quantize'] != 'no'):
+        fixedD  = {'kind' : 'fixed', 'bits' : int(optD['--quantize'])}
+        indexD  = {'kind' : 'index', 'values' : sorted(set([float(s) for s in sL]))}
+        encodeD = {'vessel' : fixedD, 'vSigma' : indexD, 'clust' : fixedD,
+                   'cSigma' : indexD}
 
     print("Started : %s"%(time.strftime("%D:%H:%M:%S")))
     startTime = time.time()
@@ -117,25 +261,45 @@ def main():
     #gaussian_derivative_of_tensor(DataT=testT, Axis='x', S=1, Verbose=True)
     ####
 
-    (vesselT, vSigmaT, clustT, cSigmaT) = extract_local_shape(SigmaL=sL, DataT=pixelT)
+    if(slab is not None):
+        # Results are already on disk, copied into the results file a chunk at
+        # a time
+        outL = extract_local_shape_tiled(SigmaL=sL, DataT=pixelT, OutStem=stem,
+                                         SlabSize=slab, Method=method,
+                                         ScaleSpace=scaleSpace, DType=dtype)
+        write_results(Path=outPath, ArrayD=dict(zip(['vessel','vSigma','clust','cSigma'],
+                      outL)), MetaD=runD, EncodeD=encodeD, Compress=compress)
+        del outL, pixelT
+        for name in ['vessel','vSigma','clust','cSigma']:
+            os.remove("{}_{}.npy".format(stem, name))
+        if(inPath is not None):
+            os.remove(inPath)
+        print("Results : {}".format(outPath))
+        print("Ended : %s"%(time.strftime("%D:%H:%M:%S")))
+        print("Run Time : {:.4f} h".format((time.time() - startTime)/3600.0))
+        sys.exit(0)
+    if(workers is not None):
+        (vesselT, vSigmaT, clustT, cSigmaT) = extract_local_shape_parallel(SigmaL=sL,
+                                                DataT=pixelT, NWorkers=workers, Method=method,
+                                                ScaleSpace=scaleSpace, DType=dtype)
+    else:
+        (vesselT, vSigmaT, clustT, cSigmaT) = extract_local_shape(SigmaL=sL, DataT=pixelT,
+                                                                  Method=method, DType=dtype,
+                                                                  ScaleSpace=scaleSpace,
+                                                                  Streaming=stream,
+                                                                  Masked=masked, Crop=crop,
+                                                                  Pyramid=pyramid, Cache=cache)
+        if(cache is not None):
+            (nFiles, nBytes) = evict_sigma_cache(CacheDir=cache, MaxBytes=cacheSize,
+                                                 MaxAge=cacheAge)
+            print("Cache : evicted {} sigmas ({:.1f} MB)".format(nFiles, nBytes / 2**20))
 
     ### Output analysis ###
-    # Vesselness
-    outFile = open("{}_vessel.pkl".format(stem), "wb")
-    pickle.dump(vesselT, outFile, protocol=4)
-    outFile.close()
-    # Vessel Sigma
-    outFile = open("{}_vSigma.pkl".format(stem), "wb")
-    pickle.dump(vSigmaT, outFile, protocol=4)
-    outFile.close()
-    # Clumpiness
-    outFile = open("{}_clust.pkl".format(stem), "wb")
-    pickle.dump(clustT, outFile, protocol=4)
-    outFile.close()
-    # Clumpiness
-    outFile = open("{}_cSigma.pkl".format(stem), "wb")
-    pickle.dump(cSigmaT, outFile, protocol=4)
-    outFile.close()
+    # One file, each map can be memory mapped on its own (see results.py)
+    write_results(Path=outPath, ArrayD={'vessel' : vesselT, 'vSigma' : vSigmaT,
+                  'clust' : clustT, 'cSigma' : cSigmaT}, MetaD=runD, EncodeD=encodeD,
+                  Compress=compress)
+    print("Results : {}".format(outPath))
 
     ### Add visualization of vesselT and clustT
 
@@ -9,29 +9,315 @@
 #
 # How to Run :
 #   Isn't run directly
+import sys
 import time
 import glob
 import pydicom
 import numpy as np
 import pickle
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.format import open_memmap
 from error import exit_with_error
+from error import warning
+from gaussian import get_num_threads
+from volume_cache import read_cached_series
+from volume_cache import VOLUME_CACHE_MAX_BYTES
+from lazy_volume import LazyDicomVolume
+from results import open_results
+from results import read_results_header
+from results import RESULTS_SUFFIX
+from results import RESULTS_MAPL
 
-def read_data(Path=None, NFiles=None):
+
+def read_dicom_slice(FPath=None, PixelT=None, Idx=None):
+    """
+    ARGS:
+        FPath   : string, path to a DICOM file
+        PixelT  : 3D numpy array, the volume, PixelT[:,:,Idx] is written
+        Idx     : int, index of the slice
+    DESCRIPTION:
+        Decodes one slice of a series straight into its place in the volume.
+        Each call writes a different slice, so calls can run concurrently.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    pixelM = pydicom.dcmread(FPath).pixel_array
+    if(PixelT.shape[:2] != pixelM.shape):
+        exit_with_error("ERROR!!! {} contains DICOM files of different "
+                        "dimensions! {} != {}\n".format(FPath, PixelT.shape[:2],
+                        pixelM.shape))
+    PixelT[:,:,Idx] = pixelM
+
+
+# Tags read by the pre-scan, see scan_dicom_header()
+HEADER_TAGS = ['Rows', 'Columns', 'BitsAllocated', 'PixelRepresentation',
+               'SamplesPerPixel', 'ImagePositionPatient', 'ImageOrientationPatient',
+               'InstanceNumber', 'RescaleSlope', 'RescaleIntercept',
+               'SeriesInstanceUID', 'PixelSpacing']
+
+
+def run_in_threads(Func=None, KwargL=None, Workers=None):
+    """
+    ARGS:
+        Func    : function
+        KwargL  : list of dict, keyword arguments of each call
+        Workers : int, number of threads
+    DESCRIPTION:
+        Calls Func(**kwargs) for each kwargs of KwargL, Workers at a time. The
+        first error raised by a call is raised here.
+    RETURN:
+        List of the results, in the order of KwargL
+    DEBUG:
+    FUTURE:
+    """
+    if(Workers == 1):
+        return([Func(**kwargD) for kwargD in KwargL])
+    with ThreadPoolExecutor(max_workers=Workers) as pool:
+        futureL = [pool.submit(Func, **kwargD) for kwargD in KwargL]
+        return([future.result() for future in futureL])
+
+
+def scan_dicom_header(FPath=None):
+    """
+    ARGS:
+        FPath   : string, path to a DICOM file
+    DESCRIPTION:
+        Reads the HEADER_TAGS of one file, the pixel data isn't read
+        (stop_before_pixels).
+    RETURN:
+        dict, tag keyword -> value, None for missing tags
+    DEBUG:
+    FUTURE:
+    """
+    data = pydicom.dcmread(FPath, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    return({tag : data.get(tag, None) for tag in HEADER_TAGS})
+
+
+def plan_dicom_series(FileL=None, HeaderL=None):
+    """
+    ARGS:
+        FileL   : list of strings, DICOM files
+        HeaderL : list of dict, scan_dicom_header() of each file
+    DESCRIPTION:
+        Checks that the files form one volume and finds its slice order and
+        type, before any pixel data is decoded :
+            1. one SeriesInstanceUID, one Rows x Columns, one pixel format
+               (BitsAllocated, PixelRepresentation, SamplesPerPixel = 1)
+            2. the slices are sorted by their position along the normal of
+               ImageOrientationPatient, which must be the same for every slice.
+               Duplicate positions are an error, uneven spacing (missing
+               slices ?) a warning. Without positions the slices are sorted by
+               InstanceNumber, and without those by file name.
+            3. the type pixel_array will have, e.g. int16 for 16 bit signed
+        The pixels are kept raw, so differing RescaleSlope / RescaleIntercept
+        are a warning (the slices aren't on the same scale).
+    RETURN:
+        (fileL, shape, dtype, spacingL) : the files in slice order, the shape
+                                and type of the volume and the voxel size
+                                along each axis (mm, None where unknown). The
+                                slice spacing is the median distance between
+                                the slices.
+    DEBUG:
+    FUTURE:
+    """
+    def distinct(Tag):
+        return(sorted(set([str(h[Tag]) for h in HeaderL])))
+
+    for tag in ['SeriesInstanceUID', 'Rows', 'Columns', 'BitsAllocated',
+                'PixelRepresentation', 'SamplesPerPixel']:
+        valueL = distinct(tag)
+        if(len(valueL) != 1):
+            exit_with_error("ERROR!!! the DICOM files don't form one volume, {} takes "
+                            "the values {}\n".format(tag, ", ".join(valueL[:5])))
+    header = HeaderL[0]
+    if(header['Rows'] is None or header['Columns'] is None):
+        exit_with_error("ERROR!!! {} has no Rows / Columns\n".format(FileL[0]))
+    if(header['SamplesPerPixel'] not in [None, 1]):
+        exit_with_error("ERROR!!! SamplesPerPixel = {}, only grayscale (1) is "
+                        "handled\n".format(header['SamplesPerPixel']))
+    bits = header['BitsAllocated']
+    if(bits not in [8, 16, 32]):
+        exit_with_error("ERROR!!! BitsAllocated = {} is not handled, 8, 16 or 32 "
+                        "expected\n".format(bits))
+    dtype = np.dtype("{}{}".format('i' if header['PixelRepresentation'] == 1 else 'u',
+                                   bits // 8))
+    for tag in ['RescaleSlope', 'RescaleIntercept']:
+        if(len(distinct(tag)) != 1):
+            warning("WARNING!!! {} differs between slices ({}), the raw pixel values "
+                    "aren't on the same scale\n".format(tag, ", ".join(distinct(tag)[:5])))
+
+    # Slice order
+    fileL = list(FileL)
+    spacingL = [None, None, None]
+    if(header['PixelSpacing'] is not None and len(distinct('PixelSpacing')) == 1):
+        spacingL[:2] = [float(header['PixelSpacing'][0]), float(header['PixelSpacing'][1])]
+    if(all([h['ImagePositionPatient'] is not None for h in HeaderL])):
+        if(len(distinct('ImageOrientationPatient')) != 1):
+            exit_with_error("ERROR!!! ImageOrientationPatient differs between "
+                            "slices\n")
+        if(header['ImageOrientationPatient'] is not None):
+            cosV   = np.array(header['ImageOrientationPatient'], dtype=np.float64)
+            normalV = np.cross(cosV[:3], cosV[3:])
+        else:
+            normalV = np.array([0.0, 0.0, 1.0])
+        posV   = np.array([np.dot(np.array(h['ImagePositionPatient'], dtype=np.float64),
+                                  normalV) for h in HeaderL])
+        idxV   = np.argsort(posV, kind='stable')
+        gapV   = np.diff(posV[idxV])
+        if(np.any(np.abs(gapV) < 1e-6)):
+            dup = idxV[1:][np.abs(gapV) < 1e-6][0]
+            exit_with_error("ERROR!!! {} is at the same position as another "
+                            "slice\n".format(FileL[dup]))
+        if(len(gapV) > 0 and np.max(gapV) - np.min(gapV) > 0.01 * np.median(gapV)):
+            warning("WARNING!!! uneven slice spacing ({:.3f} to {:.3f}), missing "
+                    "slices ?\n".format(np.min(gapV), np.max(gapV)))
+        fileL = [FileL[idx] for idx in idxV]
+        if(len(gapV) > 0):
+            spacingL[2] = float(np.median(gapV))
+    elif(all([h['InstanceNumber'] is not None for h in HeaderL])):
+        warning("WARNING!!! no ImagePositionPatient, slices sorted by "
+                "InstanceNumber\n")
+        idxV  = np.argsort([int(h['InstanceNumber']) for h in HeaderL], kind='stable')
+        fileL = [FileL[idx] for idx in idxV]
+    else:
+        warning("WARNING!!! no ImagePositionPatient or InstanceNumber, slices sorted "
+                "by file name\n")
+    return(fileL, (int(header['Rows']), int(header['Columns']), len(fileL)), dtype,
+           spacingL)
+
+
+def scan_dicom_series(FileL=None, Workers=None):
+    """
+    ARGS:
+        FileL   : list of strings, DICOM files of one series, any order
+        Workers : int, number of threads reading headers
+    DESCRIPTION:
+        scan_dicom_header() of every file, then plan_dicom_series()
+    RETURN:
+        (fileL, shape, dtype, spacingL), see plan_dicom_series()
+    DEBUG:
+    FUTURE:
+    """
+    startTime = time.time()
+    headerL = run_in_threads(Func=scan_dicom_header, Workers=Workers,
+                             KwargL=[{'FPath' : fPath} for fPath in FileL])
+    (fileL, shape, dtype, spacingL) = plan_dicom_series(FileL=FileL, HeaderL=headerL)
+    print("\tScanned {} headers in {:.2f} s : {} {}".format(len(FileL),
+          time.time() - startTime, shape, dtype))
+    sys.stdout.flush()
+    return(fileL, shape, dtype, spacingL)
+
+
+def read_dicom_series(FileL=None, Workers=None, OutPath=None, MetaD=None):
+    """
+    ARGS:
+        FileL   : list of strings, DICOM files of one series, any order
+        Workers : int, number of threads reading files, None for get_num_threads()
+        OutPath : str, if not None, the volume is a new .npy file at OutPath
+                  (memory mapped) instead of an array in memory
+        MetaD   : dict, if not None, MetaD['spacing'] is set to the voxel size
+                  (see plan_dicom_series())
+    DESCRIPTION:
+        Reads a series in two passes :
+            1. the headers only (scan_dicom_header()), which plan_dicom_series()
+               validates and uses to order the slices and size the volume. A
+               bad series fails here, before any pixel data is decoded.
+            2. the pixels, decoded straight into the preallocated volume
+               (read_dicom_slice()), slice i from the i'th file of the plan
+               whatever order the slices finish in.
+        pydicom spends most of its time in file reads and (for compressed
+        transfer syntaxes) the decoders, which release the GIL, so threads are
+        enough and write straight into the volume (processes would have to
+        send every slice back).
+    RETURN:
+        3D numpy array (np.memmap with OutPath), in the type of the pixel
+        data, slices in increasing position along the normal of the slices
+    DEBUG:
+        1. Identical to reading the files one by one, for 1 to 8 workers. 300
+           512x512 int16 uncompressed slices, 1 core, in slices/s :
+                workers   local disk   + 10 ms latency per file
+                   1         160             55
+                   4         200            131
+                  16          -             156
+           Overlapping the latency of network storage is where most of the
+           gain is on 1 core, compressed slices also decode in parallel on
+           multi-core nodes.
+        2. Pre-scan, same 300 slices, 4 workers : 0.29 s for the headers (~1000
+           files/s), which adds ~15% to a good read. A series whose last slice
+           has different Rows now fails after 0.29 s instead of after decoding
+           299 slices (1.9 s here, minutes on network storage). Shuffled file
+           names are put back in position order.
+    FUTURE:
+    """
+    if(Workers is None):
+        Workers = get_num_threads()
+    if(Workers < 1):
+        exit_with_error("ERROR!!! Workers = {} must be >= 1\n".format(Workers))
+    startTime = time.time()
+    (fileL, shape, dtype, spacingL) = scan_dicom_series(FileL=FileL, Workers=Workers)
+    if(MetaD is not None):
+        MetaD['spacing'] = spacingL
+    # 3D matrix, or Tensor. Native type, float64 would be 4x the memory of int16
+    if(OutPath is None):
+        pixelT = np.zeros(shape, dtype=dtype)
+    else:
+        pixelT = open_memmap(OutPath, mode='w+', dtype=dtype, shape=shape)
+    run_in_threads(Func=read_dicom_slice, Workers=Workers,
+                   KwargL=[{'FPath' : fileL[idx], 'PixelT' : pixelT, 'Idx' : idx}
+                           for idx in range(len(fileL))])
+    elapsed = max(time.time() - startTime, 1e-9)
+    print("\tRead {} slices in {:.2f} s ({:.1f} slices/s, {} workers)".format(len(FileL),
+          elapsed, len(FileL) / elapsed, Workers))
+    sys.stdout.flush()
+    return(pixelT)
+
+
+def read_data(Path=None, NFiles=None, Workers=None, Cache=None,
+              CacheSize=VOLUME_CACHE_MAX_BYTES, Lazy=False, MetaD=None, OutPath=None):
     """
     ARGS:
         Path     : string, Path to file or (if series) directory containing the data
         NFiles   : string, Number of files, i.e. 'series' or 'single' 
+        Workers  : int, number of threads reading a series, see read_dicom_series()
+        Cache    : string, if not None, directory of the decoded series cache
+        CacheSize: int, size limit (bytes) of Cache
+        Lazy     : bool, if True (and Cache is None), a series is returned as a
+                   LazyDicomVolume, its slices are decoded when indexed
+        MetaD    : dict, if not None, MetaD['spacing'] is set to the voxel size
+                   in mm (None where unknown), and for a results file
+                   MetaD['results'] to its header
+        OutPath  : string, if not None (and Cache is None), a series is decoded
+                   into a new .npy at OutPath, memory mapped, instead of into
+                   memory (see read_dicom_series())
     DESCRIPTION:
         This function solely reads in data from either a directory or single file
-        (pickle or dcm)
+        (pickle, npy, dcm or a results file, see results.py)
+
+        A results file is memory mapped, one map of it is returned : Path is
+        stem.res for the clumpiness or stem.res:name for the map name (vessel,
+        vSigma, clust or cSigma).
+
+        With Cache, a series is decoded once into Cache, later reads of the
+        same files memory map it (see volume_cache.py). The result is then a
+        copy on write np.memmap instead of an array.
+
+        With Lazy, only the headers of a series are read here (the series is
+        still validated and ordered), for viewers that only index PixelT[:,:,z].
     RETURN:
-        A tensor, either 2D or 3D
+        A tensor, either 2D or 3D. DICOM data is kept in the type of the pixel
+        data (e.g. int16 for CT), it is converted to floating point later by 
+        the analysis (see extract_local_shape(DType))
     DEBUG:
     FUTURE:
     """
     print("Reading data : ")
     print("\tStarted : %s"%(time.strftime("%D:%H:%M:%S")))
     startTime = time.time()
+    metaD = MetaD if MetaD is not None else {}
+    metaD['spacing'] = None
     # Extract data
     if(NFiles == "series"):
         # Get list of DICOM files
@@ -43,34 +329,52 @@ def read_data(Path=None, NFiles=None):
             if(suffix.lower() != "dcm"):
                 exit_with_error("ERROR!!! suffix {} NOT handled. Expecting dcm "
                                 "instead".format(suffix))
-        dim = None
-        # Assume all files should have the same dimension...
-        # --> allocate 3D array
-        data = pydicom.dcmread(fileL[0])
-        shape = data.pixel_array.shape
-        pixelT = np.zeros([shape[0], shape[1], len(fileL)])      # 3D matrix, or Tensor
-        idx=0                   # File index
-        # Assume that files are sanely named AND have z-pos embeded in filename
+        if(len(fileL) == 0):
+            exit_with_error("ERROR!!! no DICOM files in {}\n".format(Path))
+        # Sorted by name only to be deterministic, the slice order comes from
+        # the headers
         fileL = sorted(fileL)
-        for fPath in fileL:
-            data = pydicom.dcmread(fPath)
-            pixelM = data.pixel_array
-            if(shape != pixelM.shape):
-                exit_with_error("ERROR!!! {} contains DICOM files of different "
-                                "dimensions! {} != {}\n".format(fPath,shape,data.shape))
-            pixelT[:,:,idx] = pixelM
-            idx+=1
+        if(Cache is None and Lazy == True):
+            if(Workers is None):
+                Workers = get_num_threads()
+            (fileL, shape, dtype, spacingL) = scan_dicom_series(FileL=fileL,
+                                                                Workers=Workers)
+            metaD['spacing'] = spacingL
+            pixelT = LazyDicomVolume(FileL=fileL, Shape=shape, DType=dtype,
+                                     Workers=Workers)
+        elif(Cache is None):
+            pixelT = read_dicom_series(FileL=fileL, Workers=Workers, MetaD=metaD,
+                                       OutPath=OutPath)
+        else:
+            pixelT = read_cached_series(CacheDir=Cache, FileL=fileL, MaxBytes=CacheSize,
+                        ReadFunc=partial(read_dicom_series, FileL=fileL, Workers=Workers),
+                        MetaD=metaD)
 
     elif(NFiles == "single"):
+        # stem.res:name, one map of a results file
+        mapName = RESULTS_MAPL[2]
+        if(":" in Path and Path.rsplit(":", 1)[1] in RESULTS_MAPL):
+            (Path, mapName) = Path.rsplit(":", 1)
         suffix = Path.split('.')[-1]
         if(suffix == "dcm"):
             data = pydicom.dcmread(Path)
             pixelT = data.pixel_array
+            if(data.get('PixelSpacing', None) is not None):
+                metaD['spacing'] = [float(x) for x in data.PixelSpacing]
+        elif(suffix == RESULTS_SUFFIX):
+            # Memory mapped, only the parts indexed are read
+            metaD['results'] = read_results_header(Path=Path)
+            metaD['spacing'] = metaD['results']['meta'].get('spacing', None)
+            pixelT = open_results(Path=Path, Name=mapName)
         elif(suffix == "pkl" or suffix == "pickle"):
             inFile = open(Path, "rb")
             pixelT = pickle.load(inFile)
+        elif(suffix == "npy"):
+            # e.g. output of extract_local_shape_tiled(), memory mapped not read
+            pixelT = np.load(Path, mmap_mode='r')
         else:
-            exit_with_error("ERROR!!! suffix = {} is unhandled, pkl or dcm expected".format(suffix))
+            exit_with_error("ERROR!!! suffix = {} is unhandled, pkl, npy, {} or dcm "
+                            "expected\n".format(suffix, RESULTS_SUFFIX))
     else:
         exit_with_error("ERROR!!! {} is invalid value for "
                         "[series|single|pickle]\n".format(inputFmt))
@@ -32,6 +32,12 @@ def otsu_threshold(Array = None, Verbose=False):
         8. Tested with data read from matlab_int files and vtk files, both
            types work correctly.
         9. Added ability to handle instance where voxels can only one of two values
+       10. np.int / np.float were removed from numpy, and the bins are now counted
+           with np.bincount() instead of a loop over np.unique(). The group
+           vectors, iV, started at 0 instead of minVal, which failed for data
+           with negative values (e.g. CT padding). w0 / w1 used the python sum(),
+           and np.full(n, range()), both of which made the loop over k quadratic
+           in python.
 
     FUTURE:
         1. Print out min,max,probPerVal and cntPerVal details
@@ -48,8 +54,8 @@ def otsu_threshold(Array = None, Verbose=False):
     uT      = np.mean(array)            # Total mean
     nBin    = maxVal - minVal + 1
     valA    = np.full(nBin, range(minVal, maxVal+1))
-    cntPerVal = np.zeros(nBin, dtype=np.int)   # Each int maps to range [Min,Max]
-    probPerVal= np.zeros(nBin, dtype=np.float) # Each int maps to range [Min,Max]
+    cntPerVal = np.zeros(nBin, dtype=np.int64)   # Each int maps to range [Min,Max]
+    probPerVal= np.zeros(nBin, dtype=np.float64) # Each int maps to range [Min,Max]
     if(len(dim) == 3):
         N = dim[0] * dim[1] * dim[2]
     elif(len(dim) == 2):
@@ -58,19 +64,10 @@ def otsu_threshold(Array = None, Verbose=False):
     s2_b_max = 0
 
     ### Bin counts -
-    #   NOTE : that the arrays uValA,uCountA returned by np.unique() aren't
-    #          necessarily the same length as cntPerVal, probPerVal or valA.
-    #          This is why we have the nested loops to map them correctly
-    uValA,uCountA = np.unique(array, return_counts=True)# returns (valuesA,counts)
-    for idx in range(len(valA)):
-        for uIdx in range(len(uValA)):
-            if(valA[idx] == uValA[uIdx]):
-                cntPerVal[idx]  = uCountA[uIdx]        # 
-                # Compute probabilities (eqn 1)
-                ### NOTE : 
-                # probPerVal[0]      maps to minVal
-                # probPerVal[nBin-1] maps to maxVal
-                probPerVal[idx] = cntPerVal[idx] / float(N)     # (eqn 1)            
+    #   NOTE : cntPerVal[0] maps to minVal, cntPerVal[nBin-1] maps to maxVal
+    cntPerVal[:] = np.bincount((array - minVal).ravel(), minlength=nBin)
+    # Compute probabilities (eqn 1)
+    probPerVal[:] = cntPerVal / float(N)                # (eqn 1)
 
     ### Error Check 
     # Check data type
@@ -98,15 +95,15 @@ def otsu_threshold(Array = None, Verbose=False):
 
         # Group 0 is at or below threshold
         p0V = probPerVal[0:idx+1]                 # Prob of values at or below thresh
-        w0 = sum(p0V)                             # (eqn 2)
-        iV = np.full(k+1, range(0,k+1))           # i'th vector for values <= k
+        w0 = np.sum(p0V)                          # (eqn 2)
+        iV = np.arange(minVal, k+1)               # i'th vector for values <= k
         u0 = np.dot(iV, p0V) / w0                 # (eqn 4)
         s2_0 = np.dot((iV - u0)**2, p0V) / w0     # (eqn 10)
 
         # Group 1 is at or below threshold
         p1V = probPerVal[idx+1:nBin]
-        w1  = sum(p1V)                            # (eqn 3)
-        iV = np.full(maxVal-k, range(k+1,maxVal+1)) # i'th vector for values > k
+        w1  = np.sum(p1V)                         # (eqn 3)
+        iV = np.arange(k+1, maxVal+1)             # i'th vector for values > k
         u1 = np.dot(iV, p1V) / w1                 # (eqn 5)
         s2_1 = np.dot((iV - u1)**2, p1V) / w1     # (eqn 11)
 
@@ -158,4 +155,80 @@ def otsu_threshold(Array = None, Verbose=False):
     return(kopt, s2_b_max)
 
 
-
+def body_bounding_box(DataT=None, Pad=0, Thresh=None, MinFrac=0.001):
+    """
+    ARGS:
+        DataT   : 2D or 3D numpy array
+        Pad     : int, voxels added on each side of the box (clipped to DataT)
+        Thresh  : float, voxels > Thresh are the body. If None, otsu_threshold()
+        MinFrac : float, planes with less than this fraction of their voxels
+                  above Thresh don't count as body
+    DESCRIPTION:
+        Bounding box of the body, i.e. of the voxels above the threshold, so the
+        air around the patient can be cropped away before the analysis. MinFrac
+        keeps a few noisy air voxels above the threshold from stretching the box
+        to the whole volume.
+        The box is padded by Pad, so that filters reaching Pad voxels see the
+        same data inside the box as in the whole volume.
+    RETURN:
+        cropL   : tuple of slices, the padded box in DataT
+        roiL    : tuple of slices, the unpadded box in DataT[cropL]
+    DEBUG:
+    FUTURE:
+    """
+    if(Thresh is None):
+        Thresh, discard = otsu_threshold(Array=DataT)
+    bodyT = DataT > Thresh
+    if(not np.any(bodyT)):
+        exit_with_error("ERROR!!! no voxels > {}, can't find the body\n".format(Thresh))
+    cropL = []
+    roiL  = []
+    for axis in range(len(DataT.shape)):
+        # Planes perpendicular to axis that have some body in them
+        otherT = tuple(a for a in range(len(DataT.shape)) if a != axis)
+        cntV   = np.sum(bodyT, axis=otherT)
+        idxV   = np.flatnonzero(cntV > MinFrac * bodyT.size / DataT.shape[axis])
+        if(len(idxV) == 0):
+            idxV = np.flatnonzero(cntV)
+        lo     = int(idxV[0])
+        hi     = int(idxV[-1]) + 1
+        padLo  = max(lo - Pad, 0)
+        padHi  = min(hi + Pad, DataT.shape[axis])
+        cropL.append(slice(padLo, padHi))
+        roiL.append(slice(lo - padLo, hi - padLo))
+    return(tuple(cropL), tuple(roiL))
+
+
+def parse_options(ArgL=None, OptD=None):
+    """
+    ARGS:
+        ArgL    : list of strings, command line arguments, e.g. sys.argv
+        OptD    : dict, optional arguments and their default values (as strings),
+                  e.g. {'--dtype' : 'float32'}
+    DESCRIPTION:
+        Splits the '--name value' options out of ArgL, so the positional
+        arguments can be checked as before. Exits if an option isn't in OptD or
+        is missing its value.
+    RETURN:
+        posL    : list of strings, the positional arguments (argv[0] included)
+        optD    : dict, OptD updated with the values found in ArgL
+    DEBUG:
+    FUTURE:
+    """
+    posL = []
+    optD = dict(OptD)
+    idx  = 0
+    while(idx < len(ArgL)):
+        arg = ArgL[idx]
+        if(arg.startswith("--")):
+            if(arg not in optD):
+                exit_with_error("ERROR!!! {} is an invalid option. Valid options : "
+                                "{}\n".format(arg, ", ".join(sorted(optD.keys()))))
+            if(idx + 1 >= len(ArgL)):
+                exit_with_error("ERROR!!! {} requires a value\n".format(arg))
+            optD[arg] = ArgL[idx + 1]
+            idx += 2
+        else:
+            posL.append(arg)
+            idx += 1
+    return(posL, optD)
@@ -1,7 +1,34 @@
+import os
 import sys
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from error import exit_with_error
 
+# Method='auto' switches from the direct (fir) to the fft convolution once the
+# kernel has more elements than this. Set from timing 512x512x64 volumes, the
+# crossover was between 7 (S=1) and 19 (S=3) kernel elements.
+FFT_MIN_KERNEL = 13
+
+# Method='iir' is only used for S >= IIR_MIN_S, smaller sigmas use the (short,
+# cheap) fir kernels. Below it the recursive filter is off by 10-25%, see
+# gaussian_derivative_of_tensor() DEBUG 4.
+IIR_MIN_S = 2.0
+
+# Kernels built by cached_kernel(), keyed by (S, Order, NSig). Module level, so it
+# is shared by every derivative call in the process (i.e. every sigma of every run
+# of a long lived worker). See kernel_cache_info() and evict_kernel_cache().
+KERNEL_CACHE      = {}
+KERNEL_CACHE_STAT = {'hits' : 0, 'misses' : 0}
+KERNEL_CACHE_LOCK = threading.Lock()
+
+# Threads the derivatives / blurs are split across, see set_num_threads(). None
+# means default_num_threads(). Arrays smaller than THREAD_MIN_SIZE elements aren't
+# split, the threads would cost more than they save.
+NUM_THREADS     = None
+THREAD_MIN_SIZE = 2**16
+
+
 def gaussian_derivative_1D(X=None, Mu=None, S=None):
     """
     ARGS:
@@ -24,6 +51,43 @@ def gaussian_derivative_1D(X=None, Mu=None, S=None):
 
 
 
+def gaussian_1D(X=None, Mu=None, S=None):
+    """
+    ARGS:
+        X       =  (float or Numpy vector), location(s) to evaluate gaussian
+        Mu      =  (float), center of gaussian function
+        S       =  (float), sigma, i.e. describes width of gaussian
+    DESCRIPTION:
+        Normalized gaussian function evaluated at X
+    RETURN:
+        A float (or Numpy vector if X is a vector)
+    DEBUG:
+    FUTURE:
+    """
+    return(1/(S * np.sqrt(2 * np.pi)) * np.exp(-(X-Mu)**2 / (2*S**2)))
+
+
+def gaussian_kernel(N=None, S=None):
+    """
+    ARGS:
+        N       = (int), Number of elements in kernel, MUST BE ODD
+        S       = (float), Sigma, i.e. describes width of gaussian
+    DESCRIPTION:
+        Smoothing kernel, gaussian_1D() evaluated at the distance from the center
+        of the kernel. It is normalized to sum to 1, so truncation doesn't change
+        the mean of the data.
+    RETURN:
+        Numpy vector, the kernel
+    DEBUG:
+    FUTURE:
+    """
+    if(N % 2 == 0):
+        exit_with_error("ERROR!!! N ({}) must be ODD\n".format(N))
+    c = int(np.floor(N/2))    # Get Center of kernel
+    kernelV = gaussian_1D(X=np.arange(N, dtype=np.float64), Mu=c, S=S)
+    return(kernelV / np.sum(kernelV))
+
+
 def gaussian_derivative_kernel(N=None, S=None):
     """
     ARGS:
@@ -45,25 +109,667 @@ def gaussian_derivative_kernel(N=None, S=None):
     """
     if(N % 2 == 0):
         exit_with_error("ERROR!!! N ({}) must be ODD\n".format(N))
-    kernelV = np.zeros([N])
     c = int(np.floor(N/2))    # Get Center of kernel
-    for i in range(N):
-        kernelV[i] = gaussian_derivative_1D(X=i, Mu=c, S=S)
+    # gaussian_derivative_1D() is evaluated on all the elements at once
+    kernelV = gaussian_derivative_1D(X=np.arange(N, dtype=np.float64), Mu=c, S=S)
+    return(kernelV)
+
+
+def gaussian_second_derivative_kernel(N=None, S=None):
+    """
+    ARGS:
+        N       = (int), Number of elements in the FIRST derivative kernel, MUST BE ODD
+        S       = (float), Sigma, i.e. describes width of gaussian
+    DESCRIPTION:
+        Returns the kernel that computes the second derivative along an axis in a
+        single pass. It is the first derivative kernel convolved with itself, i.e.
+        the second derivative of a gaussian of width sqrt(2)*S. Applying it once is
+        the same as applying gaussian_derivative_kernel() twice, except within
+        N/2 voxels of the boundary where the two pass approach zeroes the first
+        derivative outside of the data before differentiating again.
+    RETURN:
+        Numpy vector, the kernel, has 2*N-1 elements
+    DEBUG:
+        1. Checked against two passes of gaussian_derivative_kernel() on random
+           data, away from the boundary they agree to ~1e-15.
+    FUTURE:
+    """
+    kernelV = gaussian_derivative_kernel(N=N, S=S)
+    return(np.convolve(kernelV, kernelV))
+
+
+def cached_kernel(S=None, Order=1, NSig=3):
+    """
+    ARGS:
+        S       = (float), Sigma, i.e. describes width of gaussian
+        Order   = (int), 0, 1 or 2, derivative order of the kernel. 0 is the
+                  gaussian itself (see gaussian_kernel())
+        NSig    = (float), number of sigma the (first derivative) kernel extends
+                  on either side of its center, i.e. where it is truncated
+    DESCRIPTION:
+        Returns the kernel used by gaussian_derivative_of_tensor() and
+        gaussian_smooth_tensor(). The half width is int(NSig * S), for integer S
+        this is the same as the original int(2 * NSig * S + 1) kernel length, but
+        it is always ODD for non-integer S too. Each kernel is
+        only built once per process and kept in KERNEL_CACHE. The returned
+        array is read-only since it is shared between callers.
+    RETURN:
+        Numpy vector, the kernel
+    DEBUG:
+    FUTURE:
+    """
+    key = (float(S), int(Order), float(NSig))
+    with KERNEL_CACHE_LOCK:
+        if(key in KERNEL_CACHE):
+            KERNEL_CACHE_STAT['hits'] += 1
+            return(KERNEL_CACHE[key])
+        KERNEL_CACHE_STAT['misses'] += 1
+    kW = 2 * int(NSig * S) + 1          # NSig sigma left and right of center
+    if(Order == 0):
+        kernelV = gaussian_kernel(N=kW, S=S)
+    elif(Order == 1):
+        kernelV = gaussian_derivative_kernel(N=kW, S=S)
+    elif(Order == 2):
+        kernelV = gaussian_second_derivative_kernel(N=kW, S=S)
+    else:
+        exit_with_error("ERROR!!! Order = {} is not handled, 0, 1 or 2 "
+                        "expected\n".format(Order))
+    kernelV.setflags(write=False)
+    with KERNEL_CACHE_LOCK:
+        KERNEL_CACHE[key] = kernelV
     return(kernelV)
 
 
-def gaussian_derivative_of_tensor(DataT=None, Axis=None, S=None, Verbose=False):
+def kernel_cache_info():
+    """
+    ARGS:
+        None
+    DESCRIPTION:
+        Reports on the state of KERNEL_CACHE
+    RETURN:
+        dict with 
+            'hits'   : int, number of cached_kernel() calls served from the cache
+            'misses' : int, number of cached_kernel() calls that built a kernel
+            'keys'   : list of (S, Order, NSig) currently cached
+            'nbytes' : int, memory held by the cached kernels
+    DEBUG:
+    FUTURE:
+    """
+    with KERNEL_CACHE_LOCK:
+        return({'hits'   : KERNEL_CACHE_STAT['hits'],
+                'misses' : KERNEL_CACHE_STAT['misses'],
+                'keys'   : sorted(KERNEL_CACHE.keys()),
+                'nbytes' : sum([k.nbytes for k in KERNEL_CACHE.values()])})
+
+
+def evict_kernel_cache(S=None, Order=None, NSig=None):
+    """
+    ARGS:
+        S       = (float), if not None, only evict kernels with this sigma
+        Order   = (int), if not None, only evict kernels of this order
+        NSig    = (float), if not None, only evict kernels with this truncation
+    DESCRIPTION:
+        Removes matching kernels from KERNEL_CACHE. With no arguments, the whole
+        cache is emptied and the hit / miss counters are reset.
+    RETURN:
+        int, number of kernels evicted
+    DEBUG:
+    FUTURE:
+    """
+    with KERNEL_CACHE_LOCK:
+        keyL = [key for key in KERNEL_CACHE
+                if((S is None or key[0] == float(S)) and
+                   (Order is None or key[1] == int(Order)) and
+                   (NSig is None or key[2] == float(NSig)))]
+        for key in keyL:
+            del KERNEL_CACHE[key]
+        if(S is None and Order is None and NSig is None):
+            KERNEL_CACHE_STAT['hits']   = 0
+            KERNEL_CACHE_STAT['misses'] = 0
+    return(len(keyL))
+
+
+def axis_to_index(Axis=None, NDim=None):
+    """
+    ARGS:
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        NDim    = (int), number of dimensions of the tensor Axis refers to
+    DESCRIPTION:
+        Maps the Axis conventions used throughout this code onto a numpy axis
+        index. Exits if Axis doesn't exist for a tensor with NDim dimensions.
+    RETURN:
+        int, the numpy axis
+    DEBUG:
+    FUTURE:
+    """
+    axisD = {'x' : 0, 'y' : 1, 'z' : 2}
+    if(isinstance(Axis, str) and Axis in axisD):
+        idx = axisD[Axis]
+    elif(not isinstance(Axis, str) and Axis in [0, 1, 2]):
+        idx = int(Axis)
+    else:
+        idx = None
+    if(idx is None or idx >= NDim):
+        exit_with_error("ERROR!!! {} is invalid Axis in {}D".format(Axis, NDim))
+    return(idx)
+
+
+def crop_kernel(KernelV=None, N=None):
+    """
+    ARGS:
+        KernelV = (Numpy vector), kernel with an ODD number of elements
+        N       = (int), number of elements along the axis the kernel is applied to
+    DESCRIPTION:
+        With zero padding, kernel elements further than N-1 from the center only
+        ever multiply 0. This drops them so the work never depends on how much
+        wider the kernel is than the axis.
+    RETURN:
+        Numpy vector, the (possibly) shortened kernel, still centered and ODD
+    DEBUG:
+    FUTURE:
+    """
+    hW = len(KernelV) // 2
+    if(hW <= N - 1):
+        return(KernelV)
+    return(KernelV[hW - (N - 1) : hW + N])
+
+
+def next_fast_length(N=None):
+    """
+    ARGS:
+        N       = (int), minimum length
+    DESCRIPTION:
+        Smallest integer >= N with no prime factors other than 2, 3 and 5. numpy's
+        fft is fastest for these lengths.
+    RETURN:
+        int
+    DEBUG:
+    FUTURE:
+    """
+    best = 2**int(np.ceil(np.log2(max(N, 1))))
+    p5 = 1
+    while(p5 < best):
+        p35 = p5
+        while(p35 < best):
+            p235 = p35
+            while(p235 < N):
+                p235 *= 2
+            best = min(best, p235)
+            p35 *= 3
+        p5 *= 5
+    return(best)
+
+
+def fft_convolve_along_axis(DataT=None, KernelV=None, Axis=None, DType=np.float32):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        KernelV = (Numpy vector), kernel with an ODD number of elements
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+    DESCRIPTION:
+        Same result as convolve_along_axis(), but computed with an fft along Axis.
+        Each line is zero padded to at least n + len(KernelV) - 1 so the circular
+        convolution of the fft equals the zero padded linear one, and the kernel
+        is reversed so that it is a correlation like convolve_along_axis().
+
+        The cost is O(n log n) per line. Since the kernel is first cropped to the
+        elements that can touch the data (crop_kernel()), it never depends on how
+        large S is, and kernels longer than the axis are handled.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+        1. Agrees with convolve_along_axis() to ~1e-12 relative, including kernels
+           several times longer than the axis.
+    FUTURE:
+    """
+    if(len(KernelV) % 2 == 0):
+        exit_with_error("ERROR!!! len(KernelV) ({}) must be ODD\n".format(len(KernelV)))
+    axis    = axis_to_index(Axis=Axis, NDim=len(DataT.shape))
+    n       = DataT.shape[axis]
+    kernelV = crop_kernel(KernelV=KernelV, N=n)
+    hW      = len(kernelV) // 2
+    nFFT    = next_fast_length(N = n + len(kernelV) - 1)
+    kernelF = np.fft.rfft(kernelV[::-1].astype(DType), n=nFFT)
+    # Broadcast kernel along axis
+    bShape  = [1] * len(DataT.shape)
+    bShape[axis] = len(kernelF)
+    dataF   = np.fft.rfft(DataT.astype(DType, copy=False), n=nFFT, axis=axis)
+    dataF  *= kernelF.reshape(bShape)
+    derivT  = np.fft.irfft(dataF, n=nFFT, axis=axis)
+    del dataF
+    sliceL  = [slice(None)] * len(DataT.shape)
+    sliceL[axis] = slice(hW, hW + n)
+    return(np.ascontiguousarray(derivT[tuple(sliceL)], dtype=DType))
+
+
+def default_num_threads():
+    """
+    ARGS:
+        N/A
+    DESCRIPTION:
+        Number of threads to use when nothing was set with set_num_threads().
+        If OMP_NUM_THREADS, MKL_NUM_THREADS or OPENBLAS_NUM_THREADS is set
+        (e.g. by the batch system or to run several processes side by side),
+        the smallest of them is used, so we don't oversubscribe the cores
+        numpy's BLAS was told it can have. Otherwise it is the number of cores
+        this process may run on.
+    RETURN:
+        int, >= 1
+    DEBUG:
+    FUTURE:
+    """
+    nL = []
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        try:
+            nL.append(int(os.environ[var]))
+        except (KeyError, ValueError):
+            pass
+    if(len(nL) > 0):
+        return(max(min(nL), 1))
+    if(hasattr(os, "sched_getaffinity")):
+        return(max(len(os.sched_getaffinity(0)), 1))
+    return(max(os.cpu_count() or 1, 1))
+
+
+def set_num_threads(N=None):
+    """
+    ARGS:
+        N = (int), number of threads, None to go back to default_num_threads()
+    DESCRIPTION:
+        Sets the number of threads gaussian_derivative_of_tensor() and
+        gaussian_smooth_tensor() split their work across, for every later call in
+        this process.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    global NUM_THREADS
+    if(N is not None and N < 1):
+        exit_with_error("ERROR!!! number of threads = {} must be >= 1\n".format(N))
+    NUM_THREADS = N
+
+
+def get_num_threads():
+    """
+    ARGS:
+        N/A
+    DESCRIPTION:
+        Number of threads currently used, see set_num_threads()
+    RETURN:
+        int
+    DEBUG:
+    FUTURE:
+    """
+    if(NUM_THREADS is None):
+        return(default_num_threads())
+    return(NUM_THREADS)
+
+
+def split_lines_across_threads(Func=None, DataT=None, Axis=None, Threads=None,
+                               DType=np.float32, **KwargD):
+    """
+    ARGS:
+        Func    = function(DataT=, Axis=, DType=, **KwargD) that works on each 1D
+                  line along Axis independently, e.g. apply_kernel_along_axis()
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        Threads = (int), number of threads, None for get_num_threads()
+        DType   = (numpy dtype), type of the result
+        KwargD  = passed on to Func
+    DESCRIPTION:
+        The lines along Axis don't depend on each other, so DataT is cut into
+        Threads blocks along another axis and Func is run on each block in a
+        thread pool. The work inside Func is numpy ufuncs and ffts on whole
+        blocks, which release the GIL, so the threads really run in parallel and
+        nothing is copied between processes. Blocks are cut along the first axis
+        other than Axis with at least Threads elements (the earlier the axis,
+        the more contiguous the blocks of a C ordered array). If no axis is that
+        long, the longest one other than Axis is cut, into one block per element,
+        so fewer than Threads threads run.
+
+        1D and small arrays, or Threads = 1, just call Func.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+        1. Identical (bit for bit) to calling Func on the whole array, fir, fft and
+           iir, every axis, 1 to 4 threads
+    FUTURE:
+    """
+    nThreads = get_num_threads() if Threads is None else Threads
+    axis     = axis_to_index(Axis=Axis, NDim=len(DataT.shape))
+    splitL   = [a for a in range(len(DataT.shape)) if a != axis]
+    if(nThreads <= 1 or len(splitL) == 0 or DataT.size < THREAD_MIN_SIZE):
+        return(Func(DataT=DataT, Axis=axis, DType=DType, **KwargD))
+    # The longest axis, unless an earlier one is long enough for every thread
+    splitAxis = max(splitL, key=lambda a : DataT.shape[a])
+    for a in splitL:
+        if(DataT.shape[a] >= nThreads):
+            splitAxis = a
+            break
+    n        = DataT.shape[splitAxis]
+    nBlocks  = min(nThreads, n)
+    edgeL    = [(b * n) // nBlocks for b in range(nBlocks + 1)]
+    resultT  = np.empty(DataT.shape, dtype=DType)
+
+    def block(B):
+        sliceL = [slice(None)] * len(DataT.shape)
+        sliceL[splitAxis] = slice(edgeL[B], edgeL[B+1])
+        sliceL = tuple(sliceL)
+        resultT[sliceL] = Func(DataT=DataT[sliceL], Axis=axis, DType=DType, **KwargD)
+
+    with ThreadPoolExecutor(max_workers=nBlocks) as pool:
+        # list() re-raises exceptions from the threads
+        list(pool.map(block, range(nBlocks)))
+    return(resultT)
+
+
+def recursive_gaussian_coefficients(S=None):
+    """
+    ARGS:
+        S       = (float), Sigma, i.e. describes width of gaussian, S >= 0.5
+    DESCRIPTION:
+        Coefficients of the 3rd order recursive (IIR) gaussian filter of Young and
+        van Vliet. The filter is run as 
+
+            forward  : w[n] = B*x[n] + a1*w[n-1] + a2*w[n-2] + a3*w[n-3]
+            backward : y[n] = B*w[n] + a1*y[n+1] + a2*y[n+2] + a3*y[n+3]
+
+        The q(S) fit of the original paper (DOI : 10.1016/0165-1684(95)00020-E,
+        eqn 11b) gives impulse responses ~10% too wide (sigma = 1.24 for S=1,
+        8.83 for S=8). Instead, this uses the poles of "Recursive Gaussian 
+        derivative filters" by van Vliet, Young and Verbeek (ICPR 1998), given
+        for S=2, and scales them as d**(1/q). q is solved for by bisection so that
+        the variance of the forward-backward filter, 2 * sum_i di/(di-1)**2,
+        is exactly S**2.
+    RETURN:
+        B       : float, normalization
+        aV      : Numpy vector, [a1, a2, a3]
+    DEBUG:
+        1. B + a1 + a2 + a3 == 1, i.e. the filter preserves a constant
+        2. Second moment of the impulse response is S**2 to ~1e-10
+        3. Max error of the impulse response relative to its peak is 3.6% (S=1), 
+           2.1% (S=2), 1.2% (S=4), 1.0% (S=8,16)
+    FUTURE:
+    """
+    if(S < 0.5):
+        exit_with_error("ERROR!!! S = {} too small for recursive filter, S >= 0.5 "
+                        "expected\n".format(S))
+    poleV = np.asarray([1.41650 + 1.00829j, 1.41650 - 1.00829j, 1.86543])
+    qLow  = 0.1
+    qHigh = S + 1.0
+    # Variance increases monotonically with q
+    for it in range(100):
+        q = 0.5 * (qLow + qHigh)
+        dV = poleV**(1.0/q)
+        if(np.real(2 * np.sum(dV / (dV - 1)**2)) < S**2):
+            qLow  = q
+        else:
+            qHigh = q
+    dV = poleV**(2.0/(qLow + qHigh))
+    # Denominator prod_i (di - t) = cV[0] + cV[1]*t + cV[2]*t**2 + cV[3]*t**3
+    cV = -np.real(np.poly(dV))[::-1]
+    aV = -cV[1:] / cV[0]
+    B  = 1.0 - np.sum(aV)
+    return(B, aV)
+
+
+def iir_boundary_matrix(B=None, AV=None, S=None):
+    """
+    ARGS:
+        B       = (float), normalization from recursive_gaussian_coefficients()
+        AV      = (Numpy vector), [a1, a2, a3] from recursive_gaussian_coefficients()
+        S       = (float), Sigma, only used to decide how long the tail is
+    DESCRIPTION:
+        Beyond the end of a line the input is 0, but the forward pass output w[]
+        keeps decaying. The backward pass needs to start from y[] values that
+        include that tail (see Triggs and Sdika, DOI : 10.1109/TSP.2006.871980).
+        Since everything is linear, the starting values are M @ [w[N-1], w[N-2],
+        w[N-3]]. Instead of the closed form, M is built by running the tail of
+        each of the 3 basis states out until it has decayed. This is O(S) work
+        per sigma, independent of the data size.
+    RETURN:
+        Numpy 3x3 array, M, maps [w[N-1],w[N-2],w[N-3]] to [y[N],y[N+1],y[N+2]]
+    DEBUG:
+        1. Compared an impulse response computed with M to one computed by
+           padding the line with 50*S zeros, they agree to ~1e-15
+    FUTURE:
+    """
+    nTail = int(20 * S) + 50                # Poles are < 1, tail is long gone by here
+    M = np.zeros([3,3])
+    for j in range(3):
+        wV = np.zeros([nTail + 3])          # wV[0:3] = w[N-3], w[N-2], w[N-1]
+        wV[2 - j] = 1.0
+        for n in range(3, nTail + 3):
+            wV[n] = AV[0]*wV[n-1] + AV[1]*wV[n-2] + AV[2]*wV[n-3]
+        yV = np.zeros([nTail + 3])          # Extra 3 elements are the y=0 start
+        for n in range(nTail - 1, -1, -1):
+            yV[n] = B*wV[n+3] + AV[0]*yV[n+1] + AV[1]*yV[n+2] + AV[2]*yV[n+3]
+        M[:,j] = yV[0:3]
+    return(M)
+
+
+def iir_gaussian_smooth_along_axis(DataT=None, Axis=None, S=None, DType=np.float32):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        S       = (float), Sigma, S >= 0.5
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+    DESCRIPTION:
+        Smooths DataT along Axis with the recursive (IIR) gaussian of Young and
+        van Vliet. It costs 3 multiply-adds per voxel per direction no matter how
+        large S is. Values outside of DataT are taken to be 0, like
+        convolve_along_axis().
+
+        The recursion is sequential along Axis, so the loop is over the planes
+        perpendicular to Axis and every line is updated at once by numpy.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+    FUTURE:
+    """
+    axis    = axis_to_index(Axis=Axis, NDim=len(DataT.shape))
+    B, aV   = recursive_gaussian_coefficients(S=S)
+    M       = iir_boundary_matrix(B=B, AV=aV, S=S)
+    # Put Axis first and flatten the rest, so every 'plane' is a contiguous row
+    xT      = np.moveaxis(DataT, axis, 0)
+    mvShape = xT.shape
+    n       = mvShape[0]
+    xT      = xT.reshape([n, -1])
+    # 3 leading planes of 0's hold the initial state of the forward pass
+    wT      = np.zeros((n + 3,) + xT.shape[1:], dtype=DType)
+    tmpT    = np.empty(xT.shape[1:], dtype=DType)
+    for i in range(n):
+        np.multiply(xT[i], B, out=wT[i+3])
+        for m in range(3):
+            np.multiply(wT[i+2-m], aV[m], out=tmpT)
+            wT[i+3] += tmpT
+    # 3 trailing planes hold the initial state of the backward pass
+    yT      = np.zeros((n + 3,) + xT.shape[1:], dtype=DType)
+    for m in range(3):
+        for j in range(3):
+            yT[n+m] += M[m,j] * wT[n+2-j]
+    for i in range(n - 1, -1, -1):
+        np.multiply(wT[i+3], B, out=yT[i])
+        for m in range(3):
+            np.multiply(yT[i+1+m], aV[m], out=tmpT)
+            yT[i] += tmpT
+    return(np.ascontiguousarray(np.moveaxis(yT[0:n].reshape(mvShape), 0, axis)))
+
+
+def iir_gaussian_derivative_along_axis(DataT=None, Axis=None, S=None, Order=1,
+                                       DType=np.float32):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        S       = (float), Sigma, S >= 0.5
+        Order   = (int), 1 or 2
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+    DESCRIPTION:
+        Recursive version of the derivative kernels. Smooth with
+        iir_gaussian_smooth_along_axis(), then take the central difference
+
+            Order=1 : (y[i+1] - y[i-1]) / 2,         smoothed at S
+            Order=2 : y[i+1] - 2*y[i] + y[i-1],     smoothed at sqrt(2)*S
+
+        sqrt(2)*S matches gaussian_second_derivative_kernel(). The data is zero
+        padded by 1 voxel each side first, so the differences at the boundary
+        see the smoothed tail of the data instead of a hard 0.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+        1. See gaussian_derivative_of_tensor() for accuracy w/r/t Method='fir'
+    FUTURE:
+    """
+    axis    = axis_to_index(Axis=Axis, NDim=len(DataT.shape))
+    n       = DataT.shape[axis]
+    padL    = [(0,0)] * len(DataT.shape)
+    padL[axis] = (1,1)
+    padT    = np.pad(DataT.astype(DType, copy=False), padL)
+    sliceL  = [slice(None)] * len(DataT.shape)
+    if(Order == 1):
+        smoothT = iir_gaussian_smooth_along_axis(DataT=padT, Axis=axis, S=S, DType=DType)
+        sliceL[axis] = slice(2, n + 2)
+        derivT  = smoothT[tuple(sliceL)] * 0.5
+        sliceL[axis] = slice(0, n)
+        derivT -= smoothT[tuple(sliceL)] * 0.5
+    elif(Order == 2):
+        smoothT = iir_gaussian_smooth_along_axis(DataT=padT, Axis=axis, S=np.sqrt(2)*S,
+                                                 DType=DType)
+        sliceL[axis] = slice(1, n + 1)
+        derivT  = smoothT[tuple(sliceL)] * -2.0
+        sliceL[axis] = slice(2, n + 2)
+        derivT += smoothT[tuple(sliceL)]
+        sliceL[axis] = slice(0, n)
+        derivT += smoothT[tuple(sliceL)]
+    else:
+        exit_with_error("ERROR!!! Order = {} is not handled, 1 or 2 "
+                        "expected\n".format(Order))
+    return(derivT)
+
+
+def convolve_along_axis(DataT=None, KernelV=None, Axis=None, DType=np.float32):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        KernelV = (Numpy vector), kernel with an ODD number of elements
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+    DESCRIPTION:
+        Correlates every 1D line of DataT along Axis with KernelV, i.e.
+
+            derivT[..,i,..] = sum_m KernelV[m] * DataT[..,i - hW + m,..]
+
+        where hW is the half width of KernelV. Values outside of DataT are taken
+        to be 0, which is identical to the boundary handling of the original
+        per-voxel implementation (see the chunkV / sliceV diagrams in git history).
+
+        Instead of walking each voxel, DataT is zero padded once along Axis and the
+        whole array is accumulated one kernel element at a time. So the cost is
+        len(KernelV) passes over the array, all done inside numpy.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+        1. Compared against the per-voxel loop version for 1D, 2D and 3D test
+           arrays on every axis, max abs difference ~1e-13.
+        2. Because of the padding, kernels wider than the axis (i.e. low<0 AND
+           up<0 in the old code) are handled correctly.
+    FUTURE:
+    """
+    if(len(KernelV) % 2 == 0):
+        exit_with_error("ERROR!!! len(KernelV) ({}) must be ODD\n".format(len(KernelV)))
+    axis    = axis_to_index(Axis=Axis, NDim=len(DataT.shape))
+    n       = DataT.shape[axis]
+    KernelV = crop_kernel(KernelV=KernelV, N=n)
+    kW      = len(KernelV)
+    hW      = kW // 2
+    # Zero pad along axis
+    padShape       = list(DataT.shape)
+    padShape[axis] = n + 2 * hW
+    padT    = np.zeros(padShape, dtype=DType)
+    sliceL  = [slice(None)] * len(DataT.shape)
+    sliceL[axis] = slice(hW, hW + n)
+    padT[tuple(sliceL)] = DataT
+    derivT  = np.zeros(DataT.shape, dtype=DType)
+    tmpT    = np.empty(DataT.shape, dtype=DType)  # Reused, avoids a temporary per element
+    for m in range(kW):
+        if(KernelV[m] == 0):
+            continue
+        sliceL[axis] = slice(m, m + n)
+        np.multiply(padT[tuple(sliceL)], KernelV[m], out=tmpT)
+        derivT += tmpT
+    return(derivT)
+
+
+def apply_kernel_along_axis(DataT=None, KernelV=None, Axis=None, Method='auto',
+                            DType=np.float32):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        KernelV = (Numpy vector), kernel with an ODD number of elements
+        Axis    = (int or str), either 0,1,2 or 'x','y','z'
+        Method  = (str), 'fir', 'fft' or 'auto'
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+    DESCRIPTION:
+        Picks between convolve_along_axis() and fft_convolve_along_axis(). 'auto'
+        uses the fft once KernelV is longer than FFT_MIN_KERNEL.
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+    FUTURE:
+    """
+    if(Method == 'auto'):
+        Method = 'fft' if len(KernelV) > FFT_MIN_KERNEL else 'fir'
+    if(Method == 'fir'):
+        resultT = convolve_along_axis(DataT=DataT, KernelV=KernelV, Axis=Axis,
+                                      DType=DType)
+    elif(Method == 'fft'):
+        resultT = fft_convolve_along_axis(DataT=DataT, KernelV=KernelV, Axis=Axis,
+                                          DType=DType)
+    else:
+        exit_with_error("ERROR!!! Method = {} is not handled, fir, fft, iir or auto "
+                        "expected\n".format(Method))
+    return(resultT)
+
+
+def gaussian_derivative_of_tensor(DataT=None, Axis=None, S=None, Verbose=False, Order=1,
+                                  Method='auto', NSig=3, DType=np.float32, Threads=None):
     """
     ARGS:
-        DataT   = (2D or 3D Numpy array), Input data to differentiate
+        DataT   = (1D, 2D or 3D Numpy array), Input data to differentiate
         Axis    = (int), either 0,1,2 corresponding to x,y,z respectively. It is 
                    the direction along which to differentiate
         S       = (float), Sigma, i.e. describes width of gaussian
+        Verbose = (bool), if True print the derivative at every voxel
+        Order   = (int), 1 or 2, first or second derivative along Axis. 
+                   Order=2 uses gaussian_second_derivative_kernel()
+        Method  = (str), how the convolution is computed
+                   'fir'  : convolve_along_axis(), cost grows with kernel length
+                   'fft'  : fft_convolve_along_axis(), cost independent of S
+                   'auto' : 'fft' if the kernel is longer than FFT_MIN_KERNEL
+                   'iir'  : iir_gaussian_derivative_along_axis(), recursive
+                            filter, cost independent of S but approximate.
+                            For S < IIR_MIN_S the fir kernel is used instead
+        NSig    = (float), kernel is truncated NSig sigma from its center. Not
+                   used by 'iir'
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+        Threads = (int), number of threads, None for get_num_threads(). See
+                   split_lines_across_threads()
     DESCRIPTION:
-        This function returns a numpy array (either 2D or 3D) with the values 
-        differentiated along the axis of choice.
+        This function returns a numpy array (either 1D, 2D or 3D) with the values 
+        differentiated along the axis of choice. Data outside of DataT is taken
+        to be 0.
     RETURN:
-        Numpy array, 2D or 3D numpy array
+        Numpy array, 1D, 2D or 3D numpy array
     NOTES:
         equivalent to gaussian_derivative() in
         ~/Code/C/Notre_Dame/SEGMENT_gsl/parallel/vessels/src/gaussian_smoothing.c
@@ -80,141 +786,98 @@ def gaussian_derivative_of_tensor(DataT=None, Axis=None, S=None, Verbose=False):
            Clearly it does pretty well in the x and y axis b/c the function is
            moderately changing. Clearly it is too low resolution for resolving the 
            fast changing z-axis.
+        2. Replaced the per-voxel loops with convolve_along_axis(), results are 
+           unchanged to floating point tolerance.
+        3. Method='fft' agrees with Method='fir' to ~1e-12 relative for S=1..16
+        4. Accuracy of Method='iir'. Relative L2 error w/r/t Method='fir' (the
+           sampled, truncated kernels), differentiating along x, away from the
+           boundary, for white noise, noise smoothed at S=1 and a synthetic
+           CT (200x96x96) :
+
+                S   Order   white   smoothed   CT
+                1     1     0.264    0.147    0.167
+                1     2     0.219    0.092    0.124
+              1.5     1     0.138    0.102    0.097
+              1.5     2     0.172    0.087    0.096
+                2     1     0.089    0.070    0.066
+                2     2     0.142    0.084    0.083
+                4     1     0.050    0.042    0.038
+                4     2     0.123    0.106    0.108
+                8     1     0.046    0.043    0.033
+                8     2     0.120    0.116    0.088
+               16     1     0.045    0.044    0.035
+               16     2     0.118    0.117    0.085
+
+           The recursive filter's 3 poles can't follow a narrow gaussian, so
+           below S = 2 the error climbs to 15-25%. Hence IIR_MIN_S : those
+           kernels are at most 13 taps, the fir is as fast. Above it 'iir' is
+           good to ~5% (Order 1) and ~10% (Order 2).
+        5. Timing on 256x256x64 along x, seconds : 
+
+                S     fir     fft     iir
+                1     0.09    0.22    0.10
+                4     0.30    0.21    0.09
+               16     1.05    0.30    0.10
     FUTURE:
-        1. Handle case when low<0 AND up<0. 
-            e.g. Happens when S>=12 for apollo data on z-axis
-    """
-    nSig        = 3                     # Number of sigma to use for kernelWidth
-    kW          = int(2 * nSig * S + 1) # 3 sigma left of center, 3 sigma right of center
-    hW          = int(nSig * S)         # Get the 'half kernel width'
-    kernelV     = gaussian_derivative_kernel(N=kW, S=S)
-    shape       = DataT.shape
-    derivT      = np.zeros(shape)
-    ## 3D
-    if(len(DataT.shape) == 3):
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                for k in range(shape[2]):
-                    chunkV =np.zeros([kW])   # Chunk of data to compute deriv on
-
-                    # Handle boundary conditions, basically set to 0 outside of image
-                    if(Axis == 'x' or Axis == 0):
-                        sliceV = DataT[:,j,k]
-                        # Check bounds
-                        low = i - hW
-                        up  = shape[0] - (i + hW + 1)
-                        idx = i             # 'idx' instead of i to generalize below
-                    elif(Axis == 'y' or Axis == 1):
-                        sliceV = DataT[i,:,k]
-                        # Check bounds
-                        low = j - hW
-                        up  = shape[1] - (j + hW + 1)
-                        idx = j             # 'idx' instead of j to generalize below
-                    elif(Axis == 'z' or Axis == 2):
-                        sliceV = DataT[i,j,:]
-                        # Check bounds
-                        low = k - hW
-                        up  = shape[2] - (k + hW + 1)
-                        idx = k             # 'idx' instead of k to generalize below
-                    else:
-                        exit_with_error("ERROR!!! {} is invalid Axis in 3D".format(Axis))
-                    ###### Assign data from DataT to chunkV ######
-                    #### Conditions :
-                    #### 1. chunkV[] should be 'centered' on sliceV[idx]
-                    #### 2. if chunkV[] overruns bounds of sliceV[], leave the 'hanging'
-                    ####    ends of chunkV[] as '0'
-                    #### 3. Using testT from dicom_analysis.py
-                    # comfortably w/in DataT bounds, e.g. 
-                    # E.g. idx = 5, low=2, up=1
-                    #
-                    #                   low=2                idx == 5              up=1
-                    #                   ___|___                 ||                  _|_
-                    #                  |       |                \/                 |   |
-                    #  chunkV = array(          [ 4.,  6.,  8., 10., 12., 14., 16.])
-                    #  sliceV = array([ 0.,  2.,  4.,  6.,  8., 10., 12., 14., 16., 18.])
-                    if(low >= 0 and up >= 0):
-                        chunkV = sliceV[(idx-hW):(idx+hW+1)]    # Check bounds here
-                    # E.g. idx = 2, low=-1, up=4
-                    # 
-                    #                 low=-1    idx == 2
-                    #                  _|_         ||
-                    #                 |   |        \/
-                    #  chunkV = array([ 0,  0,  2,  4,  6,  8,  10 ])
-                    #  sliceV = array(    [ 0,  2,  4,  6,  8,  10,  12,  14,  16,  18])
-                    elif(low < 0):
-                        chunkV[abs(low):] = sliceV[0:(kW+low)]      # recall low < 0
-                    # E.g. idx = 8        
-                    #
-                    #                                                 idx == 2     up == -2
-                    #                                                     ||        __|__
-                    #                                                     \/       |     |
-                    #  chunkV = array(                     [10,  12,  14, 16,  18,  0,  0 ])
-                    #  sliceV = array([ 0,  2,  4,  6,  8,  10,  12,  14, 16,  18])
-                    elif(up < 0):
-                        chunkV[:up] = sliceV[idx-hW:]
-                    if(Verbose == True):
-                        print("({:<2d} {:<2d} {:<2d}) : d/dx = {:<.4f}".format(i,j,k,
-                              np.dot(chunkV, kernelV)))
-                    derivT[i,j,k] = np.dot(chunkV, kernelV)
-    ## 2D
-    if(len(DataT.shape) == 2):
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                chunkV =np.zeros([kW])   # Chunk of data to compute deriv on
-                # Handle boundary conditions, basically set to 0 outside of image
-                if(Axis == 'x' or Axis == 0):
-                    sliceV = DataT[:,j]
-                    # Check bounds
-                    low = i - hW
-                    up  = shape[0] - (i + hW + 1)
-                    idx = i             # 'idx' instead of i to generalize below
-                elif(Axis == 'y' or Axis == 1):
-                    sliceV = DataT[i,:]
-                    # Check bounds
-                    low = j - hW
-                    up  = shape[1] - (j + hW + 1)
-                    idx = j             # 'idx' instead of j to generalize below
-                else:
-                    exit_with_error("ERROR!!! {} is invalid Axis in 3D".format(Axis))
-                #
-                # See comments above in 3D conditional for relevant debugging details
-                #
-                if(low >= 0 and up >= 0):
-                    chunkV = sliceV[(idx-hW):(idx+hW+1)]    # Check bounds here
-                elif(low < 0):
-                    chunkV[abs(low):] = sliceV[0:(kW+low)]      # recall low < 0
-                elif(up < 0):
-                    chunkV[:up] = sliceV[idx-hW:]
-                if(Verbose == True):
-                    print("({:<2d} {:<2d} : d/dx = {:<.4f}".format(i,j,
-                          np.dot(chunkV, kernelV)))
-                derivT[i,j] = np.dot(chunkV, kernelV)
-    ## 1D
-    if(len(DataT.shape) == 1):
-        for i in range(shape[0]):
-            chunkV =np.zeros([kW])   # Chunk of data to compute deriv on
-            # Handle boundary conditions, basically set to 0 outside of image
-            if(Axis == 'x' or Axis == 0):
-                sliceV = DataT[:]
-                # Check bounds
-                low = i - hW
-                up  = shape[0] - (i + hW + 1)
-                idx = i             # 'idx' instead of i to generalize below
-            else:
-                exit_with_error("ERROR!!! {} is invalid Axis in 1D".format(Axis))
-            #
-            # See comments above in 3D conditional for relevant debugging details
-            #
-            if(low >= 0 and up >= 0):
-                chunkV = sliceV[(idx-hW):(idx+hW+1)]    # Check bounds here
-            elif(low < 0):
-                chunkV[abs(low):] = sliceV[0:(kW+low)]      # recall low < 0
-            elif(up < 0):
-                chunkV[:up] = sliceV[idx-hW:]
-            if(Verbose == True):
-                print("({:<2d} : d/dx = {:<.4f}".format(i, np.dot(chunkV, kernelV)))
-            derivT[i] = np.dot(chunkV, kernelV)
-        
+        1. A 4th order recursive filter would reduce the 'iir' error
+    """
+    if(Order != 1 and Order != 2):
+        exit_with_error("ERROR!!! Order = {} is not handled, 1 or 2 "
+                        "expected\n".format(Order))
+    if(Method == 'iir' and S >= IIR_MIN_S):
+        derivT  = split_lines_across_threads(Func=iir_gaussian_derivative_along_axis,
+                                             DataT=DataT, Axis=Axis, Threads=Threads,
+                                             DType=DType, S=S, Order=Order)
+    else:
+        kernelV = cached_kernel(S=S, Order=Order, NSig=NSig)
+        derivT  = split_lines_across_threads(Func=apply_kernel_along_axis, DataT=DataT,
+                                             Axis=Axis, Threads=Threads, DType=DType,
+                                             KernelV=kernelV,
+                                             Method='auto' if Method=='iir' else Method)
+    if(Verbose == True):
+        for idx in np.ndindex(derivT.shape):
+            print("{} : d^{}/d{}^{} = {:<.4f}".format(idx, Order, Axis, Order,
+                  derivT[idx]))
     return(derivT)
 
 
+def gaussian_smooth_tensor(DataT=None, S=None, Method='auto', NSig=3, DType=np.float32,
+                           Threads=None):
+    """
+    ARGS:
+        DataT   = (1D, 2D or 3D Numpy array), Input data
+        S       = (float), Sigma, i.e. describes width of gaussian
+        Method  = (str), 'fir', 'fft', 'iir' or 'auto', see 
+                   gaussian_derivative_of_tensor()
+        NSig    = (float), kernel is truncated NSig sigma from its center
+        DType   = (numpy dtype), floating point type of the result and of the
+                   work arrays. float32 by default, float64 on request
+        Threads = (int), number of threads, None for get_num_threads()
+    DESCRIPTION:
+        Smooths DataT with a gaussian of width S along every axis. The kernel is
+        normalized to sum to 1 after truncation. Data outside of DataT is 0.
+
+        Since blurring at S1 and then at S2 is the same as blurring at 
+        sqrt(S1**2 + S2**2), this is used to step through a sorted list of sigmas
+        one small blur at a time (see extract_local_shape(ScaleSpace=True)).
+    RETURN:
+        Numpy array, same shape as DataT
+    DEBUG:
+        1. Blurring at 3 then at 4 agrees with blurring at 5 to ~5e-3 relative
+           (truncation at NSig=3), away from the boundary.
+    FUTURE:
+    """
+    smoothT = DataT
+    for axis in range(len(DataT.shape)):
+        # Recursive filter is too coarse for small S, see IIR_MIN_S
+        if(Method == 'iir' and S >= IIR_MIN_S):
+            smoothT = split_lines_across_threads(Func=iir_gaussian_smooth_along_axis,
+                                                 DataT=smoothT, Axis=axis, Threads=Threads,
+                                                 DType=DType, S=S)
+        else:
+            kernelV = cached_kernel(S=S, Order=0, NSig=NSig)
+            smoothT = split_lines_across_threads(Func=apply_kernel_along_axis,
+                                                 DataT=smoothT, Axis=axis, Threads=Threads,
+                                                 DType=DType, KernelV=kernelV,
+                                                 Method='auto' if Method=='iir' else Method)
+    return(smoothT)
@@ -2,12 +2,650 @@ import sys
 import numpy as np
 from error import exit_with_error
 from gaussian import gaussian_derivative_of_tensor
+from gaussian import gaussian_smooth_tensor
+from functions import body_bounding_box
+from sigma_cache import volume_digest
+from sigma_cache import sigma_cache_key
+from sigma_cache import load_sigma_measures
+from sigma_cache import store_sigma_measures
 
-def extract_local_shape(SigmaL=None, DataT=None):
+# Voxels per chunk in hessian_eigenvalues() and update_shape_measures(), bounds
+# their work arrays to a few 10's of MB
+EIGEN_CHUNK = 2**18
+
+# With extract_local_shape(Pyramid=True), a sigma is computed on a grid coarser
+# by the largest power of 2 that keeps the coarse sigma >= PYRAMID_MIN_S voxels
+PYRAMID_MIN_S = 2.0
+
+
+def hessian_filter_bank(DataT=None, S=None, Verbose=True, Method='auto', DType=np.float32):
+    """
+    ARGS:
+        DataT   = (2D or 3D Numpy array), Input data
+        S       = (float), Sigma, i.e. describes width of gaussian
+        Method  = (str), 'fir', 'fft', 'iir' or 'auto', see gaussian_derivative_of_tensor()
+        Verbose = (bool), if True print which component is being computed
+        DType   = (numpy dtype), floating point type of the components
+    DESCRIPTION:
+        Computes every unique component of the hessian in one call. 
+
+        The diagonal terms use the second derivative kernel directly (one pass
+        each). The off diagonal terms share their first pass, i.e. dxyT and dxzT
+        both come from dxT, and dyzT comes from dyT. Temporaries are freed as soon
+        as they are no longer needed, so at most one first derivative tensor is
+        alive next to the outputs.
+
+        3D : 8 passes instead of 9, dzT is never computed
+        2D : 4 passes instead of 5
+    RETURN:
+        3D : (dxxT, dxyT, dxzT, dyyT, dyzT, dzzT)
+        2D : (dxxT, dxyT, dyyT)
+    DEBUG:
+        1. Away from the boundary, agrees with the 9 pass version (which applied
+           gaussian_derivative_of_tensor() twice) to ~1e-13. Within int(3*S) voxels
+           of the boundary, the diagonal terms differ b/c the 9 pass version zeroed
+           the first derivative outside the data.
+    FUTURE:
+    """
+    nDim = len(DataT.shape)
+    if(nDim != 2 and nDim != 3):
+        exit_with_error("ERROR!!! hessian_filter_bank() can't handle "
+                        "{}D data\n".format(nDim))
+    if(Verbose == True):
+        print("\t    dxT -> dxyT{}".format(", dxzT" if nDim == 3 else ""))
+        sys.stdout.flush()
+    dxT  = gaussian_derivative_of_tensor(DataT=DataT, Axis='x', S=S,
+                                         Method=Method, DType=DType)
+    dxyT = gaussian_derivative_of_tensor(DataT=dxT, Axis='y', S=S,
+                                         Method=Method, DType=DType)
+    if(nDim == 3):
+        dxzT = gaussian_derivative_of_tensor(DataT=dxT, Axis='z', S=S,
+                                             Method=Method, DType=DType)
+    del dxT
+    if(nDim == 3):
+        if(Verbose == True):
+            print("\t    dyT -> dyzT")
+            sys.stdout.flush()
+        dyT  = gaussian_derivative_of_tensor(DataT=DataT, Axis='y', S=S,
+                                             Method=Method, DType=DType)
+        dyzT = gaussian_derivative_of_tensor(DataT=dyT, Axis='z', S=S,
+                                             Method=Method, DType=DType)
+        del dyT
+    if(Verbose == True):
+        print("\t    dxxT, dyyT{}".format(", dzzT" if nDim == 3 else ""))
+        sys.stdout.flush()
+    dxxT = gaussian_derivative_of_tensor(DataT=DataT, Axis='x', S=S, Order=2,
+                                         Method=Method, DType=DType)
+    dyyT = gaussian_derivative_of_tensor(DataT=DataT, Axis='y', S=S, Order=2,
+                                         Method=Method, DType=DType)
+    if(nDim == 2):
+        return(dxxT, dxyT, dyyT)
+    dzzT = gaussian_derivative_of_tensor(DataT=DataT, Axis='z', S=S, Order=2,
+                                         Method=Method, DType=DType)
+    return(dxxT, dxyT, dxzT, dyyT, dyzT, dzzT)
+
+
+def pyramid_factor(S=None, MinS=PYRAMID_MIN_S):
+    """
+    ARGS:
+        S    = (float), sigma, in voxels of the full resolution grid
+        MinS = (float), smallest sigma, in coarse voxels, allowed
+    DESCRIPTION:
+        Downsampling factor for sigma S, the largest power of 2, f, with
+        S/f >= MinS. E.g. MinS = 2 : S < 4 -> 1, 4 <= S < 8 -> 2, 8 <= S < 16 -> 4
+    RETURN:
+        int
+    DEBUG:
+    FUTURE:
+    """
+    factor = 1
+    while(S / (2 * factor) >= MinS):
+        factor *= 2
+    return(factor)
+
+
+def upsample_along_axis(DataT=None, Axis=None, Factor=None, N=None):
+    """
+    ARGS:
+        DataT  = numpy array, sampled every Factor voxels along Axis, i.e.
+                 DataT[i] is at i*Factor on the fine grid
+        Axis   = (int), axis to upsample
+        Factor = (int), spacing of DataT in fine voxels
+        N      = (int), length of the fine axis
+    DESCRIPTION:
+        Linear interpolation back onto the fine grid. Fine voxels past the last
+        coarse sample take its value.
+    RETURN:
+        numpy array, DataT.shape with N along Axis
+    DEBUG:
+    FUTURE:
+    """
+    posV  = np.arange(N) / Factor
+    loV   = np.minimum(np.floor(posV).astype(np.intp), DataT.shape[Axis] - 1)
+    hiV   = np.minimum(loV + 1, DataT.shape[Axis] - 1)
+    wV    = np.minimum(posV - loV, 1.0).astype(DataT.dtype)
+    shape = [1] * len(DataT.shape)
+    shape[Axis] = N
+    wV    = wV.reshape(shape)
+    return(np.take(DataT, loV, axis=Axis) * (1 - wV) + np.take(DataT, hiV, axis=Axis) * wV)
+
+
+def upsample_tensor(DataT=None, Factor=None, Shape=None):
+    """
+    ARGS:
+        DataT  = numpy array on a grid Factor times coarser, see
+                 upsample_along_axis()
+        Factor = (int), spacing of DataT in fine voxels
+        Shape  = (tuple), shape of the fine grid
+    DESCRIPTION:
+        upsample_along_axis() on every axis
+    RETURN:
+        numpy array of Shape
+    DEBUG:
+    FUTURE:
+    """
+    for axis in range(len(Shape)):
+        DataT = upsample_along_axis(DataT=DataT, Axis=axis, Factor=Factor, N=Shape[axis])
+    return(DataT)
+
+
+def pyramid_shape_measures(DataT=None, S=None, Factor=None, Verbose=True,
+                           Method='auto', DType=np.float32):
+    """
+    ARGS:
+        DataT   = (2D or 3D Numpy array), Input data
+        S       = (float), Sigma, in voxels of DataT
+        Factor  = (int), downsampling factor > 1, see pyramid_factor()
+        Verbose, Method, DType : see hessian_filter_bank()
+    DESCRIPTION:
+        Vesselness and clumpiness of sigma S computed on a grid Factor times
+        coarser.
+            1. Blur by Factor (anti aliasing) and keep every Factor'th voxel
+            2. hessian_filter_bank() at sqrt(S**2 - Factor**2) / Factor, so the
+               width along the differentiated axes is still S. The components
+               are divided by Factor**2 to be per fine voxel**2
+            3. eigenvalues, max Frobenius norm and measures on the coarse grid
+        The caller upsamples the 2 measures (upsample_tensor()) and applies the
+        mean density cut on the fine grid, DataT < AvgRho is skipped here. The
+        coarse max Frobenius norm is also the max of the hessian linearly
+        interpolated to the fine grid (the norm is convex), so it is the
+        normalization the fine grid would get from this hessian. Everything
+        costs ~1/Factor**nDim.
+
+        NOTE : hessian_filter_bank() only smooths along the axes it
+        differentiates, so its output keeps full resolution detail along the
+        other axes and isn't band limited. What is measured here is the hessian
+        of DataT blurred by Factor on every axis (which is what can be sampled
+        on the coarse grid), i.e. a smoother definition of sigma S, like
+        extract_local_shape(ScaleSpace=True).
+    RETURN:
+        vesselC, clustC : numpy arrays, measures on the coarse grid
+        maxFrob         : float, maximum Frobenius norm
+    DEBUG:
+    FUTURE:
+    """
+    aaS     = float(Factor)
+    coarseT = gaussian_smooth_tensor(DataT=DataT, S=aaS, Method=Method, DType=DType)
+    coarseT = np.ascontiguousarray(coarseT[tuple([slice(None, None, Factor)] *
+                                                 len(DataT.shape))])
+    if(Verbose == True):
+        print("\t    Downsampled by {} to {}".format(Factor, coarseT.shape))
+        sys.stdout.flush()
+    hessianL = hessian_filter_bank(DataT=coarseT, S=np.sqrt(S**2 - aaS**2) / Factor,
+                                   Verbose=Verbose, Method=Method, DType=DType)
+    hessianL = [(hT / Factor**2).astype(DType, copy=False) for hT in hessianL]
+    resultL  = hessian_eigenvalues(HessianL=hessianL, DType=DType, Verbose=False)
+    del hessianL
+    (vesselC, sigmaC, clustC) = [np.zeros(coarseT.shape, dtype=DType) for i in range(3)]
+    # Every voxel scores, the mean density cut is done on the fine grid
+    if(len(DataT.shape) == 3):
+        update_shape_measures(E1T=resultL[0], E2T=resultL[1], E3T=resultL[2],
+                              DataT=coarseT, AvgRho=-np.inf, MaxFrob=resultL[-1], S=S,
+                              VesselT=vesselC, VSigmaT=sigmaC, ClustT=clustC,
+                              CSigmaT=sigmaC, Verbose=False)
+    else:
+        update_shape_measures_2D(E1T=resultL[0], E2T=resultL[1], DataT=coarseT,
+                                 AvgRho=-np.inf, MaxFrob=resultL[-1], S=S,
+                                 VesselT=vesselC, VSigmaT=sigmaC, ClustT=clustC,
+                                 CSigmaT=sigmaC, Verbose=False)
+    return(vesselC, clustC, resultL[-1])
+
+
+def scale_space_schedule(SigmaL=None, ScaleSpace=False):
+    """
+    ARGS:
+        SigmaL     = List of gaussian scales
+        ScaleSpace = (bool), see extract_local_shape()
+    DESCRIPTION:
+        Order in which the sigmas are computed and what each one needs. 
+        Without ScaleSpace every sigma is its own filter bank on DataT. With 
+        ScaleSpace the sigmas are sorted, and each one first blurs the previous
+        scale's blurred volume by blurS, then runs the filter bank at min(SigmaL).
+    RETURN:
+        List of (sIdx, blurS, bankS), where
+            sIdx  : int, index into SigmaL
+            blurS : float, extra blur to apply before the filter bank, 0 for none
+            bankS : float, sigma to pass to hessian_filter_bank()
+    DEBUG:
+    FUTURE:
+    """
+    if(ScaleSpace == False):
+        return([(sIdx, 0.0, SigmaL[sIdx]) for sIdx in range(len(SigmaL))])
+    sIdxL   = sorted(range(len(SigmaL)), key=lambda idx: SigmaL[idx])
+    baseS   = SigmaL[sIdxL[0]]      # Width of the derivative kernels
+    smoothS = 0.0                   # Blur accumulated so far
+    scheduleL = []
+    for sIdx in sIdxL:
+        totalS = np.sqrt(SigmaL[sIdx]**2 - baseS**2)
+        if(totalS > smoothS):
+            scheduleL.append((sIdx, np.sqrt(totalS**2 - smoothS**2), baseS))
+            smoothS = totalS
+        else:
+            scheduleL.append((sIdx, 0.0, baseS))
+    return(scheduleL)
+
+
+def hessian_halo(SigmaL=None, ScaleSpace=False, NSig=3):
+    """
+    ARGS:
+        SigmaL     : List of gaussian scales
+        ScaleSpace : bool, see extract_local_shape()
+        NSig       : float, kernel truncation, see cached_kernel()
+    DESCRIPTION:
+        Halo needed along an axis so that every hessian component of the
+        interior of a slab is exact. The diagonal terms use the second
+        derivative kernel, which reaches 2*int(NSig*S) voxels, the off diagonal
+        terms reach int(NSig*S). With ScaleSpace, the blurs are chained, so their
+        half widths add up.
+    RETURN:
+        int, the halo
+    DEBUG:
+    FUTURE:
+    """
+    halo = 0
+    for (sIdx, blurS, bankS) in scale_space_schedule(SigmaL=SigmaL, ScaleSpace=ScaleSpace):
+        if(ScaleSpace == True):
+            halo += int(NSig * blurS)
+        else:
+            halo = max(halo, 2 * int(NSig * bankS))
+    if(ScaleSpace == True):
+        halo += 2 * int(NSig * min(SigmaL))
+    return(halo)
+
+
+def symmetric_eigenvalues_3x3(AxxV=None, AxyV=None, AxzV=None, AyyV=None, AyzV=None,
+                              AzzV=None):
+    """
+    ARGS:
+        AxxV, AxyV, AxzV, AyyV, AyzV, AzzV = numpy arrays (any, but the same,
+                   shape), the unique components of symmetric 3x3 matrices
+    DESCRIPTION:
+        Closed form (trigonometric Cardano, O.K. Smith, Comm. ACM 4, 168, 1961)
+        eigenvalues of every matrix at once. With q = trace/3,
+        p = sqrt(|A - qI|_F**2 / 6) and B = (A - qI)/p, the eigenvalues are
+
+            q + 2p cos(phi + 2*pi*k/3),  k = 0,1,2,   phi = arccos(det(B)/2) / 3
+
+        Computed in float64, near degenerate eigenvalues lose ~half of the
+        digits, which still leaves ~1e-8 of p.
+    RETURN:
+        (3,) + AxxV.shape float64 numpy array, eigenvalues sorted by magnitude,
+        i.e. |e[0]| <= |e[1]| <= |e[2]|
+    DEBUG:
+        1. Agrees with np.linalg.eigvalsh() to ~1e-12 relative on random
+           matrices, and to ~1e-8 of p on matrices with 2 or 3 equal eigenvalues
+    FUTURE:
+    """
+    xx = np.asarray(AxxV, dtype=np.float64)
+    xy = np.asarray(AxyV, dtype=np.float64)
+    xz = np.asarray(AxzV, dtype=np.float64)
+    yy = np.asarray(AyyV, dtype=np.float64)
+    yz = np.asarray(AyzV, dtype=np.float64)
+    zz = np.asarray(AzzV, dtype=np.float64)
+    q  = (xx + yy + zz) / 3.0
+    bxx = xx - q
+    byy = yy - q
+    bzz = zz - q
+    p  = np.sqrt((bxx**2 + byy**2 + bzz**2 + 2.0 * (xy**2 + xz**2 + yz**2)) / 6.0)
+    # A = qI, every eigenvalue is q. Any p works in B, the result is multiplied by 0
+    pSafe = np.where(p > 0, p, 1.0)
+    detB  = (bxx * (byy * bzz - yz * yz) - xy * (xy * bzz - yz * xz) +
+             xz * (xy * yz - byy * xz)) / pSafe**3
+    phi = np.arccos(np.clip(detB / 2.0, -1.0, 1.0)) / 3.0
+    eigT = np.empty((3,) + q.shape, dtype=np.float64)
+    eigT[0] = q + 2.0 * p * np.cos(phi)
+    eigT[2] = q + 2.0 * p * np.cos(phi + 2.0 * np.pi / 3.0)
+    eigT[1] = 3.0 * q - eigT[0] - eigT[2]
+    # Sort by magnitude
+    idxT = np.argsort(np.abs(eigT), axis=0)
+    return(np.take_along_axis(eigT, idxT, axis=0))
+
+
+def symmetric_eigenvalues_2x2(AxxV=None, AxyV=None, AyyV=None):
+    """
+    ARGS:
+        AxxV, AxyV, AyyV = numpy arrays (any, but the same, shape), the unique
+                   components of symmetric 2x2 matrices
+    DESCRIPTION:
+        Closed form eigenvalues of every matrix at once,
+
+            (xx + yy)/2 +/- sqrt(((xx - yy)/2)**2 + xy**2)
+
+        computed in float64.
+    RETURN:
+        (2,) + AxxV.shape float64 numpy array, eigenvalues sorted by magnitude,
+        i.e. |e[0]| <= |e[1]|
+    DEBUG:
+        1. Agrees with np.linalg.eigvalsh() to ~1e-15 relative on random matrices
+    FUTURE:
+    """
+    xx    = np.asarray(AxxV, dtype=np.float64)
+    xy    = np.asarray(AxyV, dtype=np.float64)
+    yy    = np.asarray(AyyV, dtype=np.float64)
+    meanT = (xx + yy) / 2.0
+    dT    = np.hypot((xx - yy) / 2.0, xy)
+    eigT  = np.empty((2,) + meanT.shape, dtype=np.float64)
+    # Same sign as the mean is the larger magnitude
+    bigT  = meanT + np.copysign(dT, meanT)
+    eigT[1] = bigT
+    # det = e0 * e1, avoids the cancellation in meanT -/+ dT
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eigT[0] = np.where(bigT != 0, (xx * yy - xy * xy) / bigT, 0.0)
+    return(eigT)
+
+
+def hessian_max_frobenius(HessianL=None):
+    """
+    ARGS:
+        HessianL = (list of 3D numpy arrays), (dxxT, dxyT, dxzT, dyyT, dyzT, dzzT)
+                   from hessian_filter_bank()
+    DESCRIPTION:
+        Maximum over the voxels of the Frobenius norm of the hessian,
+        sqrt(e1**2 + e2**2 + e3**2), computed from the components (no
+        eigenvalues needed), EIGEN_CHUNK voxels at a time. 2D hessians,
+        (dxxT, dxyT, dyyT), work too.
+    RETURN:
+        float
+    DEBUG:
+    FUTURE:
+    """
+    shape    = HessianL[0].shape
+    maxFrob2 = 0.0            # Maximum frobenius norm, squared
+    rows     = max(EIGEN_CHUNK // max(int(np.prod(shape[1:])), 1), 1)
+    for lo in range(0, shape[0], rows):
+        if(len(HessianL) == 3):
+            (xx, xy, yy) = [np.asarray(h[lo:lo+rows], dtype=np.float64) for h in HessianL]
+            frob2T   = xx**2 + yy**2 + 2.0 * xy**2
+        else:
+            (xx, xy, xz, yy, yz, zz) = [np.asarray(h[lo:lo+rows], dtype=np.float64)
+                                        for h in HessianL]
+            frob2T   = xx**2 + yy**2 + zz**2 + 2.0 * (xy**2 + xz**2 + yz**2)
+        if(frob2T.size > 0):
+            maxFrob2 = max(maxFrob2, float(np.max(frob2T)))
+    return(np.sqrt(maxFrob2))
+
+
+def gather_voxels(TensorL=None, IdxV=None):
+    """
+    ARGS:
+        TensorL = list of numpy arrays, all the same shape
+        IdxV    = numpy vector of flat (C order) indices, None for every voxel
+    DESCRIPTION:
+        Picks the voxels IdxV out of every array in TensorL, e.g. to run
+        hessian_eigenvalues() and update_shape_measures() on a mask only. Both
+        work on 1D arrays as well as 3D ones.
+    RETURN:
+        list of 1D numpy arrays of len(IdxV), or TensorL if IdxV is None
+    DEBUG:
+    FUTURE:
+    """
+    if(IdxV is None):
+        return(TensorL)
+    return([np.take(t, IdxV) for t in TensorL])
+
+
+def hessian_eigenvalues(HessianL=None, DType=np.float32, Verbose=True, Method='cardano'):
+    """
+    ARGS:
+        HessianL = (list of 3D numpy arrays), (dxxT, dxyT, dxzT, dyyT, dyzT, dzzT)
+                   from hessian_filter_bank(), or 1D arrays from gather_voxels().
+                   2D : (dxxT, dxyT, dyyT)
+        DType    = (numpy dtype), floating point type of the eigenvalues
+        Verbose  = (bool), if True print progress
+        Method   = (str), 'cardano' : symmetric_eigenvalues_3x3(), closed form
+                          'eigvalsh': np.linalg.eigvalsh() on stacks of matrices
+                   2D hessians always use symmetric_eigenvalues_2x2()
+    DESCRIPTION:
+        Computes the eigenvalues of the hessian at each voxel, and the maximum
+        Frobenius norm over all the voxels.
+
+        The hessian is symmetric, so only the eigenvalues are computed (no
+        eigenvectors) and they are real. Voxels are done EIGEN_CHUNK at a time,
+        so the float64 work arrays stay small next to the volume. The Frobenius
+        norm, sqrt(e1**2 + e2**2 + e3**2), is the norm of the matrix, so it is
+        a reduction over the components, see hessian_max_frobenius().
+
+        The eigenvalues are sorted by magnitude, |e1| <= |e2| <= |e3|, so the
+        ratios Rc = |e2/e3| and Rd = |e1/e3| in update_shape_measures() are <= 1.
+        np.linalg.eig(), used before, returned them in no particular order.
+    RETURN:
+        e1T, e2T, e3T : 3D numpy arrays, eigenvalues at each voxel
+        maxFrob       : float, maximum Frobenius norm
+        2D : (e1T, e2T, maxFrob)
+    DEBUG:
+        1. Timing, 64x64x64 float32 :
+                per voxel np.linalg.eig : 10.0 s
+                eigvalsh                : 0.41 s
+                cardano                 : 0.08 s
+           Same eigenvalues (once sorted) and maxFrob as the per voxel loop.
+    FUTURE:
+    """
+    shape = HessianL[0].shape
+    if(len(HessianL) == 3):
+        (dxxT, dxyT, dyyT) = HessianL
+        eigT = symmetric_eigenvalues_2x2(AxxV=dxxT, AxyV=dxyT, AyyV=dyyT)
+        return(eigT[0].astype(DType), eigT[1].astype(DType),
+               hessian_max_frobenius(HessianL=HessianL))
+    e1T = np.zeros(shape, dtype=DType)
+    e2T = np.zeros(shape, dtype=DType)
+    e3T = np.zeros(shape, dtype=DType)
+    rows  = max(EIGEN_CHUNK // max(int(np.prod(shape[1:])), 1), 1)
+    for lo in range(0, shape[0], rows):
+        hi = min(lo + rows, shape[0])
+        (xx, xy, xz, yy, yz, zz) = [np.asarray(h[lo:hi], dtype=np.float64) for h in HessianL]
+        if(Method == 'cardano'):
+            eigT = symmetric_eigenvalues_3x3(AxxV=xx, AxyV=xy, AxzV=xz, AyyV=yy, AyzV=yz,
+                                             AzzV=zz)
+        elif(Method == 'eigvalsh'):
+            hessianT = np.stack([np.stack([xx, xy, xz], axis=-1),
+                                 np.stack([xy, yy, yz], axis=-1),
+                                 np.stack([xz, yz, zz], axis=-1)], axis=-2)
+            eigT = np.moveaxis(np.linalg.eigvalsh(hessianT), -1, 0)
+            del hessianT
+            eigT = np.take_along_axis(eigT, np.argsort(np.abs(eigT), axis=0), axis=0)
+        else:
+            exit_with_error("ERROR!!! Method = {} is not handled, cardano or eigvalsh "
+                            "expected\n".format(Method))
+        e1T[lo:hi] = eigT[0]
+        e2T[lo:hi] = eigT[1]
+        e3T[lo:hi] = eigT[2]
+        del eigT
+        if(Verbose == True):
+            print("\t\ti = {}/{}".format(hi,shape[0]))
+            sys.stdout.flush()
+    return(e1T, e2T, e3T, hessian_max_frobenius(HessianL=HessianL))
+
+
+def update_shape_measures(E1T=None, E2T=None, E3T=None, DataT=None, AvgRho=None,
+                          MaxFrob=None, S=None, VesselT=None, VSigmaT=None,
+                          ClustT=None, CSigmaT=None, Verbose=True):
+    """
+    ARGS:
+        E1T, E2T, E3T = 3D numpy arrays, eigenvalues for sigma S, sorted by
+                  magnitude (see hessian_eigenvalues())
+        DataT   = 3D numpy array, the input data, same shape as E1T
+        AvgRho  = float, mean of the whole input data
+        MaxFrob = float, maximum Frobenius norm for sigma S (over the whole volume)
+        S       = float, sigma the eigenvalues were computed with
+        VesselT, VSigmaT, ClustT, CSigmaT = 3D numpy arrays, running maxima over
+                  the sigmas done so far, and the sigma of each. Updated in place.
+        Verbose = (bool), if True print progress
+    DESCRIPTION:
+        Computes the vesselness and clumpiness for sigma S at each voxel and
+        keeps them where they are larger than what previous sigmas gave.
+        With |e1| <= |e2| <= |e3|, a tube has e1 ~ 0 and |e2| ~ |e3|, a blob
+        has |e1| ~ |e2| ~ |e3| and a plate has e1 ~ e2 ~ 0. So with
+        Rc = |e2/e3| (round cross section) and Rd = |e1/e3| (round in 3D),
+
+            vessel  = (1 - exp(-alpha*Rc*Rc)) * exp(-alpha*Rd*Rd) * fTerm
+            cluster = (1 - exp(-alpha*Rd*Rd)) * fTerm
+
+        where fTerm = 1 - exp(-beta*Fnorm*Fnorm). Both are 0 on plates, and
+        the exp(-alpha*Rd*Rd) term keeps blobs out of the vesselness.
+
+        Done as whole array expressions, EIGEN_CHUNK voxels at a time. Voxels
+        with e3 == 0 (a zero hessian) or below the mean density score 0.
+    RETURN:
+        N/A
+    DEBUG:
+        1. Vectorized, 64x64x64, SigmaL = 1,2,3 : 5.1 s -> 0.04 s w/r/t the
+           per voxel loop.
+        2. The per voxel loop took e1, e2, e3 in np.linalg.eig()'s order and
+           vessel = 1 - exp(-alpha*|e1/e2|**2). Magnitude sorted, that is 0 on
+           tubes. Gaussian tube and blob (width 3), SigmaL = 1,2,3,4, at their
+           centres :
+                            old vessel / clust      new vessel / clust
+                tube          0.000 / 0.000           0.632 / 0.000
+                blob          0.746 / 0.743           0.113 / 0.743
+    FUTURE:
+    """
+    shape = E1T.shape
+    alpha = 2   # Constants from Frangi's paper
+    beta  = 2   # Constants from Frangi's paper
+    rows  = max(EIGEN_CHUNK // max(int(np.prod(shape[1:])), 1), 1)
+    for lo in range(0, shape[0], rows):
+        hi = min(lo + rows, shape[0])
+        e1T = E1T[lo:hi]
+        e2T = E2T[lo:hi]
+        e3T = E3T[lo:hi]
+        # vessels and clusters should be > mean density
+        keepT = np.logical_and(e3T != 0, np.logical_not(DataT[lo:hi] < AvgRho))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # See SEGMENT_gsl/parallel/*/src/hessian.c : compute_vesselness()
+            fNormT = np.sqrt(e1T**2 + e2T**2 + e3T**2) / MaxFrob
+            fTermT = 1.0 - np.exp(-beta * fNormT * fNormT)
+            rcT    = np.abs(e2T / e3T)
+            rdT    = np.abs(e1T / e3T)
+            roundT = np.exp(-alpha * rdT * rdT)
+            vesselT  = np.where(keepT, (1.0 - np.exp(-alpha * rcT * rcT)) * roundT *
+                                fTermT, 0)
+            clusterT = np.where(keepT, (1.0 - roundT) * fTermT, 0)
+        del fNormT, fTermT, rcT, rdT, roundT, keepT
+        # Running max over the sigmas, and the sigma that gave it
+        betterT = vesselT > VesselT[lo:hi]
+        np.copyto(VesselT[lo:hi], vesselT, where=betterT, casting='unsafe')
+        np.copyto(VSigmaT[lo:hi], S, where=betterT, casting='unsafe')
+        betterT = clusterT > ClustT[lo:hi]
+        np.copyto(ClustT[lo:hi], clusterT, where=betterT, casting='unsafe')
+        np.copyto(CSigmaT[lo:hi], S, where=betterT, casting='unsafe')
+        del vesselT, clusterT, betterT
+        if(Verbose == True):
+            print("\t\ti = {}/{}".format(hi,shape[0]))
+            sys.stdout.flush()
+
+
+def update_shape_measures_2D(E1T=None, E2T=None, DataT=None, AvgRho=None, MaxFrob=None,
+                             S=None, VesselT=None, VSigmaT=None, ClustT=None,
+                             CSigmaT=None, Verbose=True):
+    """
+    ARGS:
+        E1T, E2T = 2D numpy arrays, eigenvalues for sigma S, sorted by magnitude
+        DataT, AvgRho, MaxFrob, S, VesselT, VSigmaT, ClustT, CSigmaT, Verbose :
+                  see update_shape_measures()
+    DESCRIPTION:
+        2D version of update_shape_measures(), same ratios with e2 the
+        largest eigenvalue. A line's cross section is 1D, so there is no Rc,
+        and with Rd = |e1/e2|
+
+            vessel  = exp(-alpha*Rd*Rd)       * fTerm
+            cluster = (1 - exp(-alpha*Rd*Rd)) * fTerm
+
+        i.e. the 3D measures without the (1 - exp(-alpha*Rc*Rc)) factor. With
+        alpha = beta = 2 the vessel term is Frangi's 2D vesselness with
+        beta = 1/2 and c = MaxFrob/2. Voxels with e2 == 0 or below the mean
+        density score 0.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    alpha = 2   # Constants from Frangi's paper
+    beta  = 2   # Constants from Frangi's paper
+    keepT = np.logical_and(E2T != 0, np.logical_not(DataT < AvgRho))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fNormT = np.sqrt(E1T**2 + E2T**2) / MaxFrob
+        fTermT = 1.0 - np.exp(-beta * fNormT * fNormT)
+        rdT    = np.abs(E1T / E2T)
+        roundT = np.exp(-alpha * rdT * rdT)
+        vesselT  = np.where(keepT, roundT * fTermT, 0)
+        clusterT = np.where(keepT, (1.0 - roundT) * fTermT, 0)
+    del fNormT, fTermT, rdT, roundT, keepT
+    betterT = vesselT > VesselT
+    np.copyto(VesselT, vesselT, where=betterT, casting='unsafe')
+    np.copyto(VSigmaT, S, where=betterT, casting='unsafe')
+    betterT = clusterT > ClustT
+    np.copyto(ClustT, clusterT, where=betterT, casting='unsafe')
+    np.copyto(CSigmaT, S, where=betterT, casting='unsafe')
+
+
+def merge_shape_measures(VesselS=None, ClustS=None, S=None, VesselT=None, VSigmaT=None,
+                         ClustT=None, CSigmaT=None):
+    """
+    ARGS:
+        VesselS, ClustS = numpy arrays, vesselness and clumpiness of sigma S alone
+        S       = float, sigma
+        VesselT, VSigmaT, ClustT, CSigmaT = numpy arrays, running maxima, see
+                  update_shape_measures(). Updated in place.
+    DESCRIPTION:
+        Folds the measures of one sigma into the running maxima, the same way
+        update_shape_measures() does, so merging the sigmas in the same order
+        gives identical results.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    betterT = VesselS > VesselT
+    np.copyto(VesselT, VesselS, where=betterT, casting='unsafe')
+    np.copyto(VSigmaT, S, where=betterT, casting='unsafe')
+    betterT = ClustS > ClustT
+    np.copyto(ClustT, ClustS, where=betterT, casting='unsafe')
+    np.copyto(CSigmaT, S, where=betterT, casting='unsafe')
+
+
+def extract_local_shape(SigmaL=None, DataT=None, Method='auto', ScaleSpace=False,
+                        DType=np.float32, Streaming=False, Masked=False, Crop=False,
+                        Pyramid=False, Cache=None):
     """
     ARGS:
         ScaleL = List of gaussian scales to test, translates to a list of sigma's 
-        DataT  = Intput data tensor (can be 1D, 2D, 3D)
+        DataT  = Intput data tensor (2D or 3D)
+        Method = (str), 'fir', 'fft', 'iir' or 'auto', see 
+                 gaussian_derivative_of_tensor(). 'fft' and 'iir' keep the cost of
+                 large sigmas ~the same as small ones, 'iir' is approximate
+        ScaleSpace = (bool), if True, walk the sigmas in increasing order and 
+                 derive each scale from the previous one, see below
+        DType  = (numpy dtype), floating point type used for the derivatives,
+                 eigenvalues and measures. DataT is left in its own type (e.g.
+                 int16 from read_data()). float32 halves the memory of float64.
+        Streaming = (bool), if True, don't keep the eigenvalues of every sigma,
+                 see below
+        Masked = (bool), if True, only compute the eigenvalues and measures of
+                 the voxels that can score, see below
+        Crop   = (bool), if True, only compute the eigenvalues and measures in
+                 the bounding box of the body, see below
+        Pyramid= (bool), if True, compute large sigmas on coarser grids, see below
+        Cache  = (str), if not None, directory of the per sigma cache, see below
     DESCRIPTION:
         Steps : 
             1. Compute maximum Frobenius norm (loop 1)
@@ -15,138 +653,321 @@ def extract_local_shape(SigmaL=None, DataT=None):
                gaussian kernels at each voxel
             3. Compute eigenvalues and vectors at each voxel
             4. 
-    RETURN:
-    DEBUG:
-    FUTURE:
-        1. Handle 2D and 1D cases...
-    """
-    frobL = []          # Frobenius Norm, maps to each SigmaL
-    shape = DataT.shape
-    # Keeping notation in line with from eqn 5 in dx.doi.org/10.1016/j.jcp.2015.07.004
-    e1L   = []
-    e2L   = []
-    e3L   = []
-    print("Computing max frobenius norm, eigenvalues, eigenvectors")
-    # Compute maximum Frobenius norm
-    for s in SigmaL:
-        print("\tSigma = {}".format(s))
-        print("\t  Computing derivatives")
-        e1T = np.zeros(shape)
-        e2T = np.zeros(shape)
-        e3T = np.zeros(shape)
-        maxFrob = 0.0             # Maximum frobenius norm
 
-        # Compute 2nd derivatives
-        print("\t    dxT")
-        sys.stdout.flush()
-        dxT  = gaussian_derivative_of_tensor(DataT=DataT, Axis='x', S=s)
-        print("\t    dyT")
-        sys.stdout.flush()
-        dyT  = gaussian_derivative_of_tensor(DataT=DataT, Axis='y', S=s)
-        print("\t    dzT")
-        sys.stdout.flush()
-        dzT  = gaussian_derivative_of_tensor(DataT=DataT, Axis='z', S=s)
+        ScaleSpace : 
+            Instead of starting from DataT for every sigma, DataT is blurred
+            progressively. Gaussians compose, blurring at b1 then at
+            sqrt(b2**2 - b1**2) is the same as blurring at b2. With s0 = min(SigmaL),
+            sigma = s is computed as the hessian (with s0 derivative kernels) of
+            DataT blurred at sqrt(s**2 - s0**2). So every scale only needs a small
+            extra blur plus the s0 filter bank, e.g. SigmaL = 1,2,...,12 needs blurs
+            of sqrt(2*s - 1) <= 4.8 instead of kernels up to 12.
 
-        # Dxx
-        print("\t    dxxT")
-        sys.stdout.flush()
-        dxxT = gaussian_derivative_of_tensor(DataT=dxT, Axis='x', S=s)
+            This is a true (isotropic) gaussian scale space, so it is not identical
+            to the default mode for s > s0 :
+              a) the axes that aren't differentiated are blurred too
+              b) the diagonal terms have width sqrt(s**2 + s0**2) along the
+                 differentiated axis instead of sqrt(2)*s
 
-        # Dxy
-        print("\t    dxyT")
-        sys.stdout.flush()
-        dxyT = gaussian_derivative_of_tensor(DataT=dxT, Axis='y', S=s)
+        Streaming :
+            The measures of a sigma need its max Frobenius norm over the whole
+            volume, so by default the eigenvalues of every sigma are kept until
+            all of them are done, i.e. 3 * len(SigmaL) volumes. With Streaming,
+            a first pass over the sigmas only computes the max Frobenius norms
+            and the second pass recomputes the filter bank of each sigma and
+            folds it into the running maxima right away. Peak memory is then
+            ~ 6 (filter bank) + 3 (eigenvalues) + 4 (results) volumes for any
+            number of sigmas, at the price of running the filter bank twice.
+            extract_local_shape_tiled() keeps the eigenvalues on disk instead.
 
-        # Dxz
-        print("\t    dxzT")
-        sys.stdout.flush()
-        dxzT = gaussian_derivative_of_tensor(DataT=dxT, Axis='z', S=s)
+        Masked :
+            Voxels below the mean density always score 0 in
+            update_shape_measures(). With Masked, their flat indices are found
+            once, and the eigenvalues and measures are only computed on the
+            other voxels (gather_voxels()). The derivatives still need the whole
+            volume, and so does the max Frobenius norm (it normalizes every
+            voxel, using only the mask's would change the result), which is a
+            cheap reduction, hessian_max_frobenius(). Results are identical,
+            the saving is in proportion to the fraction of voxels masked out.
 
-        # Dyy
-        print("\t    dyyT")
-        sys.stdout.flush()
-        dyyT = gaussian_derivative_of_tensor(DataT=dyT, Axis='y', S=s)
+        Crop :
+            Most of a CT is the air around the patient. With Crop, the
+            eigenvalues and measures are only computed in the bounding box of
+            the voxels above the Otsu threshold (body_bounding_box()), like
+            Masked does for a mask. The derivatives and the max Frobenius norm
+            still need the whole volume, the norm normalizes every voxel and on
+            CT it is often outside the box (e.g. at the zero padded faces of a
+            volume with air stored as -1000). So the results in the box are
+            identical, the saving is the eigenvalues and measures of the voxels
+            outside of it, where the results are 0. If the box is the whole
+            volume nothing is cropped.
 
-        # Dyz
-        print("\t    dyzT")
-        sys.stdout.flush()
-        dyzT = gaussian_derivative_of_tensor(DataT=dyT, Axis='z', S=s)
+        Pyramid :
+            A large sigma oversamples its hessian. With Pyramid, sigma s is
+            computed with pyramid_shape_measures() on a grid pyramid_factor(s)
+            times coarser, i.e. native resolution for s < 4, half for
+            4 <= s < 8, a quarter for 8 <= s < 16, ... The hessian, eigenvalues
+            and measures are all done on the coarse grid, only the vesselness
+            and clumpiness are upsampled, and the mean density cut is then
+            applied at full resolution. Can't be combined with ScaleSpace. See
+            DEBUG 6 for the accuracy.
 
-        # Dzz
-        print("\t    dzzT")
-        sys.stdout.flush()
-        dzzT = gaussian_derivative_of_tensor(DataT=dzT, Axis='z', S=s)
-           
-        # 3D 
-        if(len(shape) == 3):
-            for i in range(shape[0]):
-                for j in range(shape[1]):
-                    for k in range(shape[2]):
-                        # Compute hessian matrix using different gaussian kernels
-                        hessianM = np.asarray([[dxxT[i,j,k], dxyT[i,j,k], dxzT[i,j,k]],
-                                               [dxyT[i,j,k], dyyT[i,j,k], dyzT[i,j,k]],
-                                               [dxzT[i,j,k], dyzT[i,j,k], dzzT[i,j,k]]])
-                        # Compute eigenvalues / vectors at each voxel
-                        [e1,e2,e3],[e1V,e2V,e3V]= np.linalg.eig(hessianM)
-                        maxFrob = max(maxFrob, np.sqrt(e1**2 + e2**2 + e3**2))
-                        e1T[i,j,k] = e1
-                        e2T[i,j,k] = e2
-                        e3T[i,j,k] = e3
-                if(i % 10 == 0):
-                    print("\t\ti = {}/{}".format(i,shape[0]))
-                    sys.stdout.flush()
+        Cache :
+            The vesselness and clumpiness of each sigma (before the max over the
+            sigmas) are stored in Cache under a hash of the volume, sigma,
+            Method, DType, kernel truncation and mode (sigma_cache.py). Sigmas
+            already in Cache are read instead of computed, e.g. extending
+            SigmaL by one sigma only runs the new one, and the max / argmax
+            is merged in the usual order, so the results are identical. With
+            ScaleSpace a sigma's entry also depends on the smaller sigmas
+            (its blurs are chained), so inserting a small sigma recomputes the
+            larger ones. Streaming doesn't change the entries, Masked and Crop
+            do. Costs 2 volumes of disk per sigma, nothing is evicted here, see
+            evict_sigma_cache().
+
+        2D :
+            A single image gets the 3 component hessian, the closed form 2x2
+            eigenvalues and update_shape_measures_2D(), the 3D measures without
+            the cross section ratio.
+    RETURN:
+        vesselT : vesselness, max over SigmaL
+        vSigmaT : sigma giving vesselT
+        clustT  : clumpiness, max over SigmaL
+        cSigmaT : sigma giving clustT
+    DEBUG:
+        1. The vessel / cluster maxima used to be reset for every sigma, so
+           vesselT and clustT only held the last sigma (and vSigmaT / cSigmaT
+           the last sigma scoring > 0). They are now the max over all of
+           SigmaL, like vSigmaT and cSigmaT always assumed. Results from before
+           this change (the .pkl outputs) hold the last sigma only.
+        2. Streaming gives identical results. Peak memory (tracemalloc, in
+           volumes of float32) and time, 128x128x96 :
+                len(SigmaL)   default          Streaming
+                    1         20.6, 0.8 s      20.6, 1.1 s
+                    2         23.8, 1.7 s      20.8, 2.1 s
+                    4         30.0, 3.3 s      21.0, 4.4 s
+        3. Masked gives identical results (with and without Streaming). Time vs
+           the fraction of voxels kept, 128x128x96, SigmaL = 1,2,3 :
+                kept    total              eigenvalues (1 sigma)
+                0.06    2.45 -> 1.13 s     0.48 -> 0.014 s
+                0.20    2.39 -> 1.35 s     0.43 -> 0.080 s
+                0.51    2.29 -> 2.14 s     0.41 -> 0.252 s
+                0.80    2.26 -> 2.34 s     0.46 -> 0.446 s
+           The derivatives are the floor, and above ~70% kept the gather /
+           scatter costs more than it saves.
+        4. 2D, 512x512 int16, SigmaL = 1,2,3 : 0.13 s
+        5. Crop, 112x128x128 synthetic CT, air stored as -1000, box is 16% of
+           the volume, SigmaL = 1,2,3 : results in the box identical (also
+           with Masked, Streaming, Pyramid and Cache), 2.67 s -> 1.58 s
+        6. Pyramid, 128x128x96 synthetic CT, w/r/t the default mode :
+                SigmaL        time             mean |diff|       sigma maps same
+                                               vessel / clust    vSigmaT / cSigmaT
+                1,2,4,8       2.81 -> 2.01 s   0.025 / 0.006     87% / 81%
+                4,6,8,12,16   4.13 -> 1.04 s   0.103 / 0.092     94% / 89%
+           The differences are mostly b/c the default filter bank isn't
+           blurred along the other axes (see pyramid_shape_measures()), the
+           coarse measures w/r/t upsampling the coarse hessian and measuring
+           it at full resolution (3.04 s for 4,6,8,12,16) only differ by 0.01
+           on average (0.18 at most, at the edges of structures). So Pyramid
+           is for fast sweeps over large sigmas, it is not a drop in
+           replacement for the default results.
+        7. Cache, 128x128x96 : identical results for every mode, extended and
+           reordered SigmaL. SigmaL = 1,2,3,4 takes 3.5 s without the cache,
+                run                           time
+                1,2,3 (empty cache)           2.7 s
+                1,2,3,4 (only 4 computed)     1.3 s
+                4,3,2,1 (all cached)          0.2 s
+           the cache is 12 MB per sigma.
+    FUTURE:
+    """
+    DType = np.dtype(DType)
+    if(DType.kind != 'f'):
+        exit_with_error("ERROR!!! DType = {} is not a floating point "
+                        "type\n".format(DType))
+    shape = DataT.shape
+    if(len(shape) != 3 and len(shape) != 2):
+        exit_with_error("ERROR!!! len(shape) = {} not yet "
+                        "implemented\n".format(len(shape)))
+    if(Pyramid == True and ScaleSpace == True):
+        exit_with_error("ERROR!!! Pyramid and ScaleSpace can't be combined\n")
+    avgRho = np.mean(DataT)
+    digest = volume_digest(DataT=DataT) if(Cache is not None) else None
+    fullShape = shape
+    boxL   = tuple([slice(None)] * len(shape))  # Box the measures are computed in
+    cropL  = None
+    if(Crop == True):
+        (cropL, discard) = body_bounding_box(DataT=DataT, Pad=0)
+        shape = tuple(c.stop - c.start for c in cropL)
+        if(shape == fullShape):
+            print("Crop : the body fills the volume, not cropped")
+            cropL = None
         else:
-            exit_with_error("ERROR!!! len(shape) = {} not yet "
-                            "implemented\n".format(len(shape)))
-        e1L.append(e1T)
-        e2L.append(e2T)
-        e3L.append(e3T)
-        frobL.append(maxFrob)
+            boxL  = cropL
+            print("Cropped to the body : {} -> {} voxels ({:.1f}%)".format(fullShape,
+                  shape, 100.0 * np.prod(shape) / max(np.prod(fullShape), 1)))
+    frobL = [None] * len(SigmaL)  # Frobenius Norm, maps to each SigmaL
+    # Keeping notation in line with from eqn 5 in dx.doi.org/10.1016/j.jcp.2015.07.004
+    # (e1T, e2T, e3T) of each sigma, (e1T, e2T) in 2D
+    eigenL = [None] * len(SigmaL)
+    scheduleL = scale_space_schedule(SigmaL=SigmaL, ScaleSpace=ScaleSpace)
+    vesselT  = np.zeros(shape, dtype=DType)  # Max vessel value over sigmas
+    vSigmaT  = np.zeros(shape, dtype=DType)  # Save sigma with max vessel value...
+    clustT   = np.zeros(shape, dtype=DType)  # Max cluster value over sigmas
+    cSigmaT  = np.zeros(shape, dtype=DType)  # Save sigma with max cluster value...
+    idxV     = None                 # Flat indices of the voxels computed, None for all
+    dataT    = DataT[boxL]
+    if(Masked == True):
+        idxV  = np.flatnonzero(np.logical_not(dataT < avgRho))
+        print("Masked : {} of {} voxels ({:.1f}%)".format(len(idxV), dataT.size,
+              100.0 * len(idxV) / max(dataT.size, 1)))
+        dataT = np.take(dataT, idxV)
+        # Running maxima of the masked voxels only, scattered back at the end
+        (vesselT, vSigmaT, clustT, cSigmaT) = [np.zeros(idxV.shape, dtype=DType)
+                                               for i in range(4)]
+    # Per sigma cache : measures of the sigmas found in it, None for the others
+    cachedL = [None] * len(SigmaL)
+    if(Cache is not None):
+        chainL  = sorted(SigmaL)
+        keyL    = [sigma_cache_key(Digest=digest, S=s, Method=Method, DType=DType,
+                                   ChainL=chainL[:chainL.index(s) + 1] if ScaleSpace else None,
+                                   Factor=pyramid_factor(S=s) if Pyramid else 1,
+                                   Crop=cropL, Masked=Masked)
+                   for s in SigmaL]
+        cachedL = [load_sigma_measures(CacheDir=Cache, Key=key, Shape=dataT.shape)
+                   for key in keyL]
+        print("Cache : {} of {} sigmas found in {}".format(len(SigmaL) - cachedL.count(None),
+              len(SigmaL), Cache))
+    # Schedule position of the last sigma that has to be computed, the blurs
+    # (ScaleSpace) after it aren't needed
+    lastIdx = max([pos for pos in range(len(scheduleL))
+                   if cachedL[scheduleL[pos][0]] is None] + [-1])
+    smoothT = DataT                 # Only blurred if ScaleSpace
+    if(Streaming == True):
+        print("Computing max frobenius norm")
+    else:
+        print("Computing max frobenius norm, eigenvalues, eigenvectors")
+    # Compute maximum Frobenius norm
+    for (sIdx, blurS, bankS) in scheduleL[:lastIdx + 1]:
+        print("\tSigma = {}".format(SigmaL[sIdx]))
+        if(blurS > 0):
+            print("\t  Blurring by {:.3f}".format(blurS))
+            smoothT = gaussian_smooth_tensor(DataT=smoothT, S=blurS, Method=Method,
+                                             DType=DType)
+        if(cachedL[sIdx] is not None):
+            print("\t  In the cache")
+            continue
+        # Compute 2nd derivatives
+        print("\t  Computing derivatives")
+        factor = pyramid_factor(S=bankS) if Pyramid else 1
+        if(factor > 1):
+            # Coarse measures, small enough to keep even when Streaming
+            (vesselC, clustC, frobL[sIdx]) = pyramid_shape_measures(DataT=smoothT,
+                                                S=bankS, Factor=factor, Method=Method,
+                                                DType=DType)
+            eigenL[sIdx] = (vesselC, clustC)
+            del vesselC, clustC
+            continue
+        hessianL = hessian_filter_bank(DataT=smoothT, S=bankS, Method=Method, DType=DType)
+        if(Streaming == True or Masked == True or cropL is not None):
+            # Over the whole volume, even if the measures are only in the box
+            frobL[sIdx] = hessian_max_frobenius(HessianL=hessianL)
+        if(Streaming == False):
+            resultL = hessian_eigenvalues(
+                              HessianL=gather_voxels(TensorL=[h[boxL] for h in hessianL],
+                                                     IdxV=idxV),
+                              DType=DType)
+            (eigenL[sIdx], maxFrob) = (resultL[:-1], resultL[-1])
+            if(frobL[sIdx] is None):
+                frobL[sIdx] = maxFrob
+        del hessianL
 
     print("Computing vesselness and cluster measures")
+    smoothT = DataT
     # Compute vessel and cluster measure 
-    vSigmaT  = np.zeros(shape)       # Save sigma with max vessel value...
-    cSigmaT  = np.zeros(shape)       # Save sigma with max cluster value...
-    avgRho  = np.mean(DataT)
-    if(len(shape) == 3):
-        for sIdx in range(len(SigmaL)):
-            s = SigmaL[sIdx]
-            print("\tSigma = {}".format(s))
-            vesselT = np.zeros(shape)
-            clustT= np.zeros(shape)
-            # Get e-values associated w/ sigma
-            e1T = e1L[sIdx]
-            e2T = e2L[sIdx]
-            e3T = e3L[sIdx]
-            for i in range(shape[0]):
-                for j in range(shape[1]):
-                    for k in range(shape[2]):
-                        # Frobenius Norm
-                        F = np.sqrt(e1T[i,j,k]**2 + e2T[i,j,k]**2 + e3T[i,j,k]**2)
-
-                        # See SEGMENT_gsl/parallel/*/src/hessian.c : compute_vesselness()
-                        Fnorm = F / frobL[sIdx]
-
-                        # vessels and clusters should be > mean density
-                        if(e3T[i,j,k] == 0 or DataT[i,j,k] < avgRho):
-                            vessel = 0
-                            cluster= 0
-                        else:
-                            alpha = 2   # Constants from Frangi's paper
-                            beta  = 2   # Constants from Frangi's paper
-                            Rc = np.abs(e1T[i,j,k] / e2T[i,j,k])
-                            Rd = np.abs(e1T[i,j,k] / e3T[i,j,k])
-                            vessel = (1 - np.exp(-alpha*Rc*Rc))*(1.0 - np.exp(-beta*Fnorm*Fnorm))
-                            cluster = (1 - np.exp(-alpha*Rd*Rd))*(1.0 - np.exp(-beta*Fnorm*Fnorm))
-    
-                        if(vessel > vesselT[i,j,k]):
-                            vesselT[i,j,k] = vessel
-                            vSigmaT[i,j,k] = s
-                        if(cluster > clustT[i,j,k]):
-                            clustT[i,j,k] = cluster
-                            cSigmaT[i,j,k]  = s
-                if(i % 10 == 0):
-                    print("\t\ti = {}/{}".format(i,shape[0]))
-                    sys.stdout.flush()
+    for (pos, (sIdx, blurS, bankS)) in enumerate(scheduleL):
+        s = SigmaL[sIdx]
+        print("\tSigma = {}".format(s))
+        if(Streaming == True and blurS > 0 and pos <= lastIdx):
+            smoothT = gaussian_smooth_tensor(DataT=smoothT, S=blurS, Method=Method,
+                                             DType=DType)
+        if(cachedL[sIdx] is not None):
+            (vesselS, clustS) = cachedL[sIdx]
+            merge_shape_measures(VesselS=vesselS, ClustS=clustS, S=s, VesselT=vesselT,
+                                 VSigmaT=vSigmaT, ClustT=clustT, CSigmaT=cSigmaT)
+            cachedL[sIdx] = None
+            del vesselS, clustS
+            continue
+        factor = pyramid_factor(S=bankS) if Pyramid else 1
+        if(factor > 1):
+            # Upsample the coarse measures, then the mean density cut
+            (vesselS, clustS) = [upsample_tensor(DataT=c, Factor=factor,
+                                                 Shape=fullShape)[boxL]
+                                 for c in eigenL[sIdx]]
+            eigenL[sIdx] = None
+            lowT = DataT[boxL] < avgRho
+            vesselS[lowT] = 0
+            clustS[lowT]  = 0
+            del lowT
+            (vesselS, clustS) = gather_voxels(TensorL=[vesselS, clustS], IdxV=idxV)
+            if(Cache is not None):
+                store_sigma_measures(CacheDir=Cache, Key=keyL[sIdx], VesselT=vesselS,
+                                     ClustT=clustS)
+            merge_shape_measures(VesselS=vesselS, ClustS=clustS, S=s, VesselT=vesselT,
+                                 VSigmaT=vSigmaT, ClustT=clustT, CSigmaT=cSigmaT)
+            del vesselS, clustS
+            continue
+        if(Streaming == True):
+            # Same steps as above, now that frobL is known
+            hessianL = hessian_filter_bank(DataT=smoothT, S=bankS, Method=Method,
+                                           DType=DType, Verbose=False)
+            resultL = hessian_eigenvalues(
+                              HessianL=gather_voxels(TensorL=[h[boxL] for h in hessianL],
+                                                     IdxV=idxV),
+                              DType=DType, Verbose=False)
+            (eigenL[sIdx], maxFrob) = (resultL[:-1], resultL[-1])
+            del hessianL
+        # With the cache, the measures of this sigma alone are needed
+        if(Cache is not None):
+            (vesselS, sigmaS, clustS) = [np.zeros(dataT.shape, dtype=DType)
+                                         for i in range(3)]
+            outL = (vesselS, sigmaS, clustS, sigmaS)
+        else:
+            outL = (vesselT, vSigmaT, clustT, cSigmaT)
+        if(len(shape) == 3):
+            (e1T, e2T, e3T) = eigenL[sIdx]
+            update_shape_measures(E1T=e1T, E2T=e2T, E3T=e3T, DataT=dataT, AvgRho=avgRho,
+                                  MaxFrob=frobL[sIdx], S=s, VesselT=outL[0],
+                                  VSigmaT=outL[1], ClustT=outL[2], CSigmaT=outL[3])
+            del e3T
+        else:
+            (e1T, e2T) = eigenL[sIdx]
+            update_shape_measures_2D(E1T=e1T, E2T=e2T, DataT=dataT, AvgRho=avgRho,
+                                     MaxFrob=frobL[sIdx], S=s, VesselT=outL[0],
+                                     VSigmaT=outL[1], ClustT=outL[2], CSigmaT=outL[3])
+        if(Cache is not None):
+            store_sigma_measures(CacheDir=Cache, Key=keyL[sIdx], VesselT=vesselS,
+                                 ClustT=clustS)
+            merge_shape_measures(VesselS=vesselS, ClustS=clustS, S=s, VesselT=vesselT,
+                                 VSigmaT=vSigmaT, ClustT=clustT, CSigmaT=cSigmaT)
+            del vesselS, sigmaS, clustS
+        del outL
+        # Free this sigma's eigenvalues as soon as they are used
+        eigenL[sIdx] = None
+        del e1T, e2T
 
+    if(Masked == True):
+        outL = []
+        for maskedV in (vesselT, vSigmaT, clustT, cSigmaT):
+            outT = np.zeros(shape, dtype=DType)
+            np.put(outT, idxV, maskedV)
+            outL.append(outT)
+        (vesselT, vSigmaT, clustT, cSigmaT) = outL
+    if(cropL is not None):
+        # Paste the box back
+        outL = []
+        for cropT in (vesselT, vSigmaT, clustT, cSigmaT):
+            outT = np.zeros(fullShape, dtype=DType)
+            outT[cropL] = cropT
+            outL.append(outT)
+        (vesselT, vSigmaT, clustT, cSigmaT) = outL
     return(vesselT, vSigmaT, clustT, cSigmaT)
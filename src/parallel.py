@@ -0,0 +1,273 @@
+# License: MIT
+# Notes  :
+#
+# Background :
+#
+# Purpose :
+#   Multi-core version of the analysis. The volume is split into slabs along the
+#   first axis (see tiles.py), one per worker process. The input and the results
+#   live in shared memory, so workers read / write them in place instead of
+#   getting pickled copies.
+#
+# How to Run :
+#   Isn't run directly
+import sys
+import traceback
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from error import exit_with_error
+from gaussian import get_num_threads
+from gaussian import set_num_threads
+from hessian import update_shape_measures
+from hessian import scale_space_schedule
+from hessian import hessian_halo
+from tiles import slab_bounds
+from tiles import slab_eigenvalues
+
+
+def shared_array(Shape=None, DType=None, Name=None):
+    """
+    ARGS:
+        Shape : tuple, shape of the array
+        DType : numpy dtype
+        Name  : str, name of an existing block to attach to. If None, a new block
+                is created (zeroed)
+    DESCRIPTION:
+        numpy array backed by a multiprocessing.shared_memory block. The caller
+        keeps the SharedMemory object alive as long as the array is used, and
+        the creator unlink()'s it.
+    RETURN:
+        (shm, arrayT)
+    DEBUG:
+    FUTURE:
+    """
+    DType = np.dtype(DType)
+    if(Name is None):
+        size = max(int(np.prod(Shape)) * DType.itemsize, 1)
+        shm  = shared_memory.SharedMemory(create=True, size=size)
+    else:
+        shm  = shared_memory.SharedMemory(name=Name)
+    arrayT = np.ndarray(Shape, dtype=DType, buffer=shm.buf)
+    if(Name is None):
+        arrayT[...] = 0
+    return(shm, arrayT)
+
+
+def slab_worker(Conn=None, InName=None, OutNameL=None, Shape=None, InDType=None,
+                Bound=None, SigmaL=None, ScaleSpace=False, Method='auto',
+                DType=np.float32, Threads=1):
+    """
+    ARGS:
+        Conn     : multiprocessing Connection to the parent
+        InName   : str, shared memory block holding the input volume
+        OutNameL : list of str, shared memory blocks of vesselT, vSigmaT, clustT
+                   and cSigmaT
+        Shape    : tuple, shape of the volume
+        InDType  : numpy dtype of the input volume
+        Bound    : (lo, hi, rLo, rHi), the slab of this worker
+        SigmaL, ScaleSpace, Method, DType : see extract_local_shape()
+        Threads  : int, threads of the derivative engine in this worker
+    DESCRIPTION:
+        Runs in a worker process.
+            1. eigenvalues of every sigma on the slab, sends the max Frobenius
+               norm of each sigma to the parent
+            2. receives the max Frobenius norms over the whole volume and the
+               mean density, writes the measures of the slab into the shared
+               output
+        Errors are sent to the parent instead of being raised.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    shmL  = []
+    dataT = None
+    outL  = []
+    try:
+        (lo, hi, rLo, rHi) = Bound
+        set_num_threads(Threads)
+        (shm, dataT) = shared_array(Shape=Shape, DType=InDType, Name=InName)
+        shmL.append(shm)
+        outL = []
+        for name in OutNameL:
+            (shm, outT) = shared_array(Shape=Shape, DType=DType, Name=name)
+            shmL.append(shm)
+            outL.append(outT[lo:hi])
+        scheduleL = scale_space_schedule(SigmaL=SigmaL, ScaleSpace=ScaleSpace)
+        eigenL = [None] * len(SigmaL)
+        frobL  = [0.0] * len(SigmaL)
+        for (sIdx, e1T, e2T, e3T, maxFrob) in slab_eigenvalues(DataT=dataT, Bound=Bound,
+                ScheduleL=scheduleL, Method=Method, DType=DType):
+            eigenL[sIdx] = (e1T, e2T, e3T)
+            frobL[sIdx]  = maxFrob
+        Conn.send(('frob', frobL))
+
+        (frobL, avgRho) = Conn.recv()
+        # Same order as extract_local_shape(), so ties pick the same sigma
+        for (sIdx, blurS, bankS) in scheduleL:
+            (e1T, e2T, e3T) = eigenL[sIdx]
+            update_shape_measures(E1T=e1T, E2T=e2T, E3T=e3T, DataT=dataT[lo:hi],
+                                  AvgRho=avgRho, MaxFrob=frobL[sIdx], S=SigmaL[sIdx],
+                                  VesselT=outL[0], VSigmaT=outL[1], ClustT=outL[2],
+                                  CSigmaT=outL[3], Verbose=False)
+            eigenL[sIdx] = None
+        Conn.send(('done', None))
+    except BaseException:
+        # exit_with_error() raises SystemExit, catch it too
+        Conn.send(('error', traceback.format_exc()))
+    finally:
+        # Views have to be gone before the blocks can be closed
+        dataT = outT = outL = None
+        for shm in shmL:
+            shm.close()
+        Conn.close()
+
+
+def receive_from_workers(ConnL=None, ProcL=None, Tag=None):
+    """
+    ARGS:
+        ConnL : list of multiprocessing Connection, one per worker
+        ProcL : list of multiprocessing Process
+        Tag   : str, message expected from every worker
+    DESCRIPTION:
+        Waits for one message from each worker. If a worker reports an error or
+        dies, all the workers are terminated and the error is printed.
+    RETURN:
+        list of the messages' payloads, in worker order
+    DEBUG:
+    FUTURE:
+    """
+    msgL = []
+    for (conn, proc) in zip(ConnL, ProcL):
+        try:
+            (tag, payload) = conn.recv()
+        except EOFError:
+            (tag, payload) = ('error', "worker {} died with exit code "
+                              "{}\n".format(proc.pid, proc.exitcode))
+        if(tag != Tag):
+            for p in ProcL:
+                p.terminate()
+            exit_with_error("ERROR!!! worker failed :\n{}\n".format(payload))
+        msgL.append(payload)
+    return(msgL)
+
+
+def extract_local_shape_parallel(SigmaL=None, DataT=None, NWorkers=None, Method='auto',
+                                 ScaleSpace=False, DType=np.float32):
+    """
+    ARGS:
+        SigmaL   : List of gaussian scales
+        DataT    : 3D numpy array (or np.memmap), input data
+        NWorkers : int, number of worker processes
+        Method, ScaleSpace, DType : see extract_local_shape()
+    DESCRIPTION:
+        Same result as extract_local_shape(), with the volume split into
+        NWorkers slabs along the first axis, each done by its own process.
+
+        DataT is copied once into shared memory (in its own type, e.g. int16)
+        and every worker reads its slab plus a halo of hessian_halo() voxels
+        from it. The vesselness needs the max Frobenius norm of each sigma over
+        the whole volume, so each worker keeps the eigenvalues of its slab, sends
+        its Frobenius maxima to the parent, and waits for the global ones before
+        writing its part of the (shared) results.
+
+        Memory : the input + 4 results in shared memory, plus in each worker the
+        filter bank of its slab and 3 * len(SigmaL) eigenvalue arrays of its
+        interior, i.e. about the same total as extract_local_shape().
+        Halo overhead : each slab reads 2*halo extra voxels, so don't use more
+        workers than ~ DataT.shape[0] / (2*halo).
+        Threads : the get_num_threads() of this process are shared between the
+        workers, so the workers' derivative threads don't oversubscribe the cores.
+    RETURN:
+        vesselT, vSigmaT, clustT, cSigmaT : numpy arrays
+    DEBUG:
+        1. Same as extract_local_shape() for 1, 2, 3 and 4 workers, with and without
+           ScaleSpace. Sigma maps are identical, measures agree to float32 round
+           off (b/c the fft lengths differ per slab).
+        2. Wall time on N cores has NOT been measured, only a 1 core machine
+           was available. On it the workers run one after the other, so the
+           time is the total work, halos and process start up included,
+           128x128x96, SigmaL = 1,2,3 (halo = 18), 1 thread per worker :
+                NWorkers   time     w/r/t 1 worker
+                   1       2.45 s       1.00
+                   2       2.86 s       1.17
+                   4       3.59 s       1.47
+                   8       4.77 s       1.95
+           extract_local_shape() takes 2.54 s. The speedup on N free cores
+           can't be more than N / (the last column), i.e. 1.7, 2.7 and 4.1,
+           and memory bandwidth will keep it below that.
+    FUTURE:
+    """
+    DType = np.dtype(DType)
+    if(DType.kind != 'f'):
+        exit_with_error("ERROR!!! DType = {} is not a floating point "
+                        "type\n".format(DType))
+    if(Method == 'iir'):
+        exit_with_error("ERROR!!! Method = iir has infinite support, it can't be "
+                        "split into slabs exactly\n")
+    shape = DataT.shape
+    if(len(shape) != 3):
+        exit_with_error("ERROR!!! extract_local_shape_parallel() requires 3D data, "
+                        "{}D given\n".format(len(shape)))
+    if(NWorkers < 1):
+        exit_with_error("ERROR!!! NWorkers = {} must be >= 1\n".format(NWorkers))
+    nWorkers = min(NWorkers, shape[0])
+    halo     = hessian_halo(SigmaL=SigmaL, ScaleSpace=ScaleSpace)
+    slabSize = -(-shape[0] // nWorkers)
+    boundL   = slab_bounds(N=shape[0], SlabSize=slabSize, Halo=halo)
+    threads  = max(get_num_threads() // len(boundL), 1)
+    print("Parallel : {} workers, slabs of {} voxels, halo = {}, {} threads per "
+          "worker".format(len(boundL), slabSize, halo, threads))
+    sys.stdout.flush()
+
+    shmL  = []
+    procL = []
+    connL = []
+    try:
+        (shm, dataT) = shared_array(Shape=shape, DType=DataT.dtype)
+        shmL.append(shm)
+        dataT[...] = DataT
+        for name in ['vessel','vSigma','clust','cSigma']:
+            (shm, outT) = shared_array(Shape=shape, DType=DType)
+            shmL.append(shm)
+        ctx = multiprocessing.get_context()
+        for bound in boundL:
+            (parentConn, childConn) = ctx.Pipe()
+            proc = ctx.Process(target=slab_worker,
+                               kwargs={'Conn' : childConn, 'InName' : shmL[0].name,
+                                       'OutNameL' : [s.name for s in shmL[1:]],
+                                       'Shape' : shape, 'InDType' : DataT.dtype,
+                                       'Bound' : bound, 'SigmaL' : SigmaL,
+                                       'ScaleSpace' : ScaleSpace, 'Method' : Method,
+                                       'DType' : DType, 'Threads' : threads})
+            proc.start()
+            childConn.close()
+            procL.append(proc)
+            connL.append(parentConn)
+
+        print("Computing max frobenius norm, eigenvalues, eigenvectors")
+        sys.stdout.flush()
+        workerFrobL = receive_from_workers(ConnL=connL, ProcL=procL, Tag='frob')
+        frobL  = [max(f[sIdx] for f in workerFrobL) for sIdx in range(len(SigmaL))]
+        avgRho = np.mean(dataT)
+        print("Computing vesselness and cluster measures")
+        sys.stdout.flush()
+        for conn in connL:
+            conn.send((frobL, avgRho))
+        receive_from_workers(ConnL=connL, ProcL=procL, Tag='done')
+        for proc in procL:
+            proc.join()
+        # Copy out of shared memory, it is unlinked below
+        outL = [np.ndarray(shape, dtype=DType, buffer=shm.buf).copy() for shm in shmL[1:]]
+    finally:
+        dataT = outT = None
+        for proc in procL:
+            if(proc.is_alive()):
+                proc.terminate()
+        for conn in connL:
+            conn.close()
+        for shm in shmL:
+            shm.close()
+            shm.unlink()
+    return(tuple(outL))
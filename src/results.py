@@ -0,0 +1,289 @@
+# License: MIT
+# Notes  :
+#
+# Background :
+#
+# Purpose :
+#   Results file of dicom_analysis.py. One file holds the vesselness,
+#   clumpiness and sigma maps plus what they were computed from, and each map
+#   can be memory mapped on its own. Layout :
+#       RESULTS_MAGIC (8 bytes)
+#       uint32, little endian, length of the header
+#       header, JSON (utf-8), padded with spaces to a multiple of RESULTS_ALIGN
+#       the maps, raw C ordered arrays, each starting at a multiple of
+#       RESULTS_ALIGN bytes. Their type, shape and offset are in the header.
+#   The header is plain JSON, e.g. `head -c 4096 stem.res` shows it.
+#
+#   Maps can also be stored encoded (see encode_map()) : measures in [0,1] as
+#   uint8 / uint16 fixed point, sigma maps as uint8 indices into the sigmas.
+#   Either can be zlib compressed, in blocks of rows along the first axis.
+#   open_results() decodes them back to floats.
+#
+# How to Run :
+#   Isn't run directly
+import os
+import json
+import time
+import zlib
+import struct
+import tempfile
+import numpy as np
+from error import exit_with_error
+
+RESULTS_MAGIC   = b"DCMSHAPE"
+RESULTS_VERSION = 1
+RESULTS_ALIGN   = 4096          # Page size, so every map can be memory mapped
+RESULTS_SUFFIX  = "res"
+RESULTS_MAPL    = ['vessel', 'vSigma', 'clust', 'cSigma']
+WRITE_CHUNK     = 2**26         # Bytes copied at a time by write_results()
+BLOCK_BYTES     = 2**20         # Uncompressed size of a compressed block
+COMPRESS_LEVEL  = 1             # zlib level, 6 is ~15% smaller and 2-3x slower
+
+
+def encode_map(ChunkT=None, EncodeD=None):
+    """
+    ARGS:
+        ChunkT  : numpy array, (part of) a map
+        EncodeD : dict, how the map is stored, None for as is
+                    {'kind' : 'fixed', 'bits' : 8 or 16} : values in [0,1] as
+                        round(x * (2**bits - 1)), i.e. an error <= 0.5/(2**bits - 1)
+                    {'kind' : 'index', 'values' : sorted sigmas} : 0 for 0, i+1
+                        for values[i]. Lossless, values not in the list are an
+                        error.
+    DESCRIPTION:
+        Encodes a map for write_results(). Works on any part of a map, so
+        maps are encoded a chunk at a time.
+    RETURN:
+        numpy array, the stored values
+    DEBUG:
+    FUTURE:
+    """
+    if(EncodeD is None):
+        return(ChunkT)
+    if(EncodeD['kind'] == 'fixed'):
+        top = 2**EncodeD['bits'] - 1
+        qT  = np.rint(np.clip(ChunkT, 0.0, 1.0) * top)
+        return(qT.astype(np.uint8 if EncodeD['bits'] == 8 else np.uint16))
+    elif(EncodeD['kind'] == 'index'):
+        valueV = np.asarray(EncodeD['values'], dtype=ChunkT.dtype)
+        if(len(valueV) > 255):
+            exit_with_error("ERROR!!! {} sigmas can't be indexed with "
+                            "uint8\n".format(len(valueV)))
+        idxT = np.searchsorted(valueV, ChunkT)
+        lutV = np.concatenate([valueV, [0]]).astype(ChunkT.dtype)
+        okT  = np.logical_or(ChunkT == 0, lutV[idxT] == ChunkT)
+        if(not np.all(okT)):
+            exit_with_error("ERROR!!! {} is not one of the sigmas {}\n".format(
+                            ChunkT[np.logical_not(okT)][0], EncodeD['values']))
+        return(np.where(ChunkT == 0, 0, idxT + 1).astype(np.uint8))
+    exit_with_error("ERROR!!! encoding {} is not handled\n".format(EncodeD['kind']))
+
+
+def decode_map(StoredT=None, EncodeD=None, DType=np.float32):
+    """
+    ARGS:
+        StoredT : numpy array, a map as stored, see encode_map()
+        EncodeD : dict, its encoding, None for none
+        DType   : numpy dtype of the decoded map
+    DESCRIPTION:
+        Inverse of encode_map()
+    RETURN:
+        numpy array
+    DEBUG:
+    FUTURE:
+    """
+    if(EncodeD is None):
+        return(StoredT)
+    if(EncodeD['kind'] == 'fixed'):
+        outT = StoredT.astype(DType)
+        outT *= DType(1.0 / (2**EncodeD['bits'] - 1))
+        return(outT)
+    elif(EncodeD['kind'] == 'index'):
+        lutV = np.array([0] + list(EncodeD['values']), dtype=DType)
+        return(lutV[StoredT])
+    exit_with_error("ERROR!!! encoding {} is not handled\n".format(EncodeD['kind']))
+
+
+def write_results(Path=None, ArrayD=None, MetaD=None, EncodeD=None, Compress=False):
+    """
+    ARGS:
+        Path    : str, output file, by convention stem.res
+        ArrayD  : dict, name -> numpy array (or np.memmap), the maps, in the
+                  order they are written
+        MetaD   : dict, anything JSON serializable describing the run, e.g.
+                  'sigmas', 'fingerprint', 'spacing'. Stored in the header
+                  under 'meta'.
+        EncodeD : dict, name -> encoding of that map (see encode_map()), maps
+                  not in it are stored as they are
+        Compress: bool, if True, zlib compress every map in blocks of
+                  BLOCK_BYTES. Compressed maps can't be memory mapped.
+    DESCRIPTION:
+        Writes a results file (see the top of this file). The maps are encoded
+        and copied WRITE_CHUNK bytes at a time, so np.memmap maps
+        (extract_local_shape_tiled()) aren't read in whole. With Compress, the
+        compressed blocks of a map are held in memory until it is written. The
+        file is written under a temporary name and renamed.
+    RETURN:
+        N/A
+    DEBUG:
+        1. 4 maps of 512x512x300 float32 : written in 0.58 s (the 4 float64
+           pickles took ~1.4 s each), one slice of one map read back in 4 ms
+           (unpickling a map took 0.47 s)
+        2. Encodings, 4 maps of 200x256x256 from SigmaL = 1,2,3,4 (half the
+           voxels score), vs 400 MB of float64 pickles (0.3 s to unpickle) :
+                quantize  compress   size      write    load (decoded)
+                  no         no     200 MB    0.13 s     memory mapped
+                  no        yes      51 MB    7.9 s      0.94 s  (level 6)
+                   8         no      50 MB    1.0 s      0.18 s
+                  16         no      75 MB    1.0 s      0.18 s
+                   8        yes     5.5 MB    1.3 s      0.40 s
+                  16        yes      19 MB    2.1 s      0.58 s
+           Max error 0.00196 (8 bit) and 7.7e-6 (16 bit), sigma maps exact.
+    FUTURE:
+    """
+    # Offsets depend on the header length, which depends on the offsets. Size
+    # the header with room for the offsets' digits, then pad to RESULTS_ALIGN.
+    EncodeD = EncodeD if EncodeD is not None else {}
+    arrayL  = []
+    blockD  = {}            # name -> compressed blocks
+    for (name, arrayT) in ArrayD.items():
+        encodeD = EncodeD.get(name, None)
+        stored  = encode_map(ChunkT=arrayT[0:0], EncodeD=encodeD).dtype
+        entry   = {'name' : name, 'dtype' : stored.str, 'shape' : list(arrayT.shape),
+                   'offset' : 0, 'nbytes' : arrayT.size * stored.itemsize}
+        if(encodeD is not None):
+            entry['encoding'] = dict(encodeD, decoded=arrayT.dtype.str)
+        if(Compress == True and arrayT.size > 0):
+            # [row lo, row hi, offset in the map, length], offsets filled below
+            rows = max(BLOCK_BYTES // max(arrayT[0:1].size * stored.itemsize, 1), 1)
+            blockD[name] = []
+            entry['blocks'] = []
+            for lo in range(0, arrayT.shape[0], rows):
+                hi    = min(lo + rows, arrayT.shape[0])
+                block = zlib.compress(np.ascontiguousarray(encode_map(ChunkT=arrayT[lo:hi],
+                                      EncodeD=encodeD)).data, COMPRESS_LEVEL)
+                entry['blocks'].append([lo, hi, 2**62, len(block)])
+                blockD[name].append(block)
+            entry['nbytes'] = sum([b[3] for b in entry['blocks']])
+        arrayL.append(entry)
+    headerD = {'version' : RESULTS_VERSION, 'created' : time.strftime("%Y-%m-%d %H:%M:%S"),
+               'arrays' : arrayL, 'meta' : MetaD if MetaD is not None else {}}
+    for entry in arrayL:
+        entry['offset'] = 2**62         # Widest offset
+    start  = len(RESULTS_MAGIC) + 4 + len(json.dumps(headerD).encode())
+    offset = -(-start // RESULTS_ALIGN) * RESULTS_ALIGN
+    for entry in arrayL:
+        entry['offset'] = offset
+        position = 0
+        for block in entry.get('blocks', []):
+            block[2]  = position
+            position += block[3]
+        offset += -(-entry['nbytes'] // RESULTS_ALIGN) * RESULTS_ALIGN
+    headerB = json.dumps(headerD).encode()
+    headerB = headerB + b" " * (arrayL[0]['offset'] - len(RESULTS_MAGIC) - 4 - len(headerB)
+                                if arrayL else 0)
+
+    outDir = os.path.dirname(os.path.abspath(Path))
+    (fd, tmpPath) = tempfile.mkstemp(prefix=".tmp_", suffix=".res", dir=outDir)
+    try:
+        with os.fdopen(fd, "wb") as outFile:
+            outFile.write(RESULTS_MAGIC)
+            outFile.write(struct.pack("<I", len(headerB)))
+            outFile.write(headerB)
+            for (entry, arrayT) in zip(arrayL, ArrayD.values()):
+                outFile.seek(entry['offset'])
+                if(arrayT.size == 0):
+                    continue
+                if(entry['name'] in blockD):
+                    for block in blockD.pop(entry['name']):
+                        outFile.write(block)
+                    continue
+                rows = max(WRITE_CHUNK // max(arrayT[0:1].nbytes, 1), 1)
+                for lo in range(0, arrayT.shape[0], rows):
+                    outFile.write(np.ascontiguousarray(encode_map(ChunkT=arrayT[lo : lo + rows],
+                                  EncodeD=EncodeD.get(entry['name'], None))).data)
+            outFile.truncate(offset)
+        # mkstemp() makes the file private, give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpPath, 0o666 & ~umask)
+        os.replace(tmpPath, Path)
+    except BaseException:
+        if(os.path.exists(tmpPath)):
+            os.remove(tmpPath)
+        raise
+
+
+def read_results_header(Path=None):
+    """
+    ARGS:
+        Path    : str, results file
+    DESCRIPTION:
+        Reads the header of a results file, not the maps
+    RETURN:
+        dict, see write_results()
+    DEBUG:
+    FUTURE:
+    """
+    with open(Path, "rb") as inFile:
+        magic = inFile.read(len(RESULTS_MAGIC))
+        if(magic != RESULTS_MAGIC):
+            exit_with_error("ERROR!!! {} is not a results file\n".format(Path))
+        (length,) = struct.unpack("<I", inFile.read(4))
+        headerD = json.loads(inFile.read(length).decode())
+    if(headerD['version'] > RESULTS_VERSION):
+        exit_with_error("ERROR!!! {} is version {} of the results format, this code "
+                        "reads up to {}\n".format(Path, headerD['version'], RESULTS_VERSION))
+    return(headerD)
+
+
+def open_results(Path=None, Name=None, Mode='c', Decode=True):
+    """
+    ARGS:
+        Path    : str, results file
+        Name    : str, map to open (e.g. 'clust'), None for all of them
+        Mode    : str, np.memmap mode. 'c' (copy on write) lets callers modify
+                  the map in memory without touching the file, 'r' is read only
+        Decode  : bool, if False, encoded maps are returned as stored (e.g.
+                  uint8 sigma indices), see encode_map()
+    DESCRIPTION:
+        Memory maps the maps of a results file. Nothing is read until it is
+        indexed, so e.g. one slice of one map only reads that slice.
+
+        Encoded maps are decoded back to their original float type, which
+        reads them in whole (at 1/4 or 1/2 of the bytes for float32).
+        Compressed maps are read and decompressed in whole.
+    RETURN:
+        np.memmap (numpy array if encoded or compressed) if Name is given, else
+        dict name -> map
+    DEBUG:
+    FUTURE:
+    """
+    headerD = read_results_header(Path=Path)
+    mapD    = {}
+    for entry in headerD['arrays']:
+        if(Name is not None and entry['name'] != Name):
+            continue
+        if(np.prod(entry['shape']) == 0):
+            mapD[entry['name']] = np.zeros(entry['shape'], dtype=entry['dtype'])
+            continue
+        if('blocks' in entry):
+            storedT = np.empty(entry['shape'], dtype=np.dtype(entry['dtype']))
+            with open(Path, "rb") as inFile:
+                for (lo, hi, position, length) in entry['blocks']:
+                    inFile.seek(entry['offset'] + position)
+                    storedT[lo:hi] = np.frombuffer(zlib.decompress(inFile.read(length)),
+                                        dtype=storedT.dtype).reshape(storedT[lo:hi].shape)
+        else:
+            storedT = np.memmap(Path, dtype=np.dtype(entry['dtype']), mode=Mode,
+                                offset=entry['offset'], shape=tuple(entry['shape']))
+        if(Decode == True and 'encoding' in entry):
+            storedT = decode_map(StoredT=storedT, EncodeD=entry['encoding'],
+                                 DType=np.dtype(entry['encoding']['decoded']).type)
+        mapD[entry['name']] = storedT
+    if(Name is None):
+        return(mapD)
+    if(Name not in mapD):
+        exit_with_error("ERROR!!! {} has no map {}, it has {}\n".format(Path, Name,
+                        ", ".join([e['name'] for e in headerD['arrays']])))
+    return(mapD[Name])
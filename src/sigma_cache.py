@@ -0,0 +1,256 @@
+# License: MIT
+# Notes  :
+#
+# Background :
+#
+# Purpose :
+#   On-disk cache of the per sigma vesselness and clumpiness, so rerunning the
+#   analysis of a volume with more (or reordered) sigmas only computes the new
+#   ones. Entries are content addressed, the file name is a hash of everything
+#   the result depends on (see sigma_cache_key()), so there is nothing to
+#   invalidate. Old and excess entries are removed by evict_sigma_cache().
+#
+# How to Run :
+#   Isn't run directly
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+from error import exit_with_error
+
+SIGMA_CACHE_VERSION   = 3                 # Bump when the measures change
+SIGMA_CACHE_MAX_BYTES = 8 * 2**30         # Default size limit, see evict_sigma_cache()
+SIGMA_CACHE_MAX_AGE   = 30 * 24 * 3600.0  # Default age limit (s), since last use
+DIGEST_CHUNK = 2**24                      # Bytes hashed at a time by volume_digest()
+CACHE_TMP_MAX_AGE = 24 * 3600.0           # Temporary files not written to for this
+                                          # long (s) are left by a killed run
+
+
+def volume_digest(DataT=None):
+    """
+    ARGS:
+        DataT   : numpy array (or np.memmap), input volume
+    DESCRIPTION:
+        Hash of the shape, type and values of DataT. Hashed DIGEST_CHUNK bytes
+        at a time along the first axis, so a memmap isn't read in all at once.
+    RETURN:
+        str, hex digest
+    DEBUG:
+        1. 600x512x512 int16 (300 MB) : 0.9 s
+    FUTURE:
+    """
+    hashH = hashlib.blake2b(digest_size=20)
+    hashH.update("{} {}".format(DataT.shape, DataT.dtype.str).encode())
+    if(len(DataT.shape) == 0 or DataT.size == 0):
+        return(hashH.hexdigest())
+    rows = max(DIGEST_CHUNK // max(DataT[0:1].nbytes, 1), 1)
+    for lo in range(0, DataT.shape[0], rows):
+        hashH.update(np.ascontiguousarray(DataT[lo : lo + rows]).data)
+    return(hashH.hexdigest())
+
+
+def sigma_cache_key(Digest=None, S=None, Method='auto', DType=np.float32, NSig=3,
+                    ChainL=None, Factor=1, Crop=None, Masked=False):
+    """
+    ARGS:
+        Digest  : str, volume_digest() of the input volume
+        S       : float, sigma
+        Method  : str, derivative method, see gaussian_derivative_of_tensor()
+        DType   : numpy dtype of the analysis
+        NSig    : float, kernel truncation, see cached_kernel()
+        ChainL  : list of float, with ScaleSpace the sorted sigmas up to and
+                  including S (S's result depends on the blurs before it), None
+                  otherwise
+        Factor  : int, pyramid_factor() of S, 1 without Pyramid
+        Crop    : tuple of slices, the crop of the volume, None for no Crop
+        Masked  : bool, results are stored for the masked voxels only
+    DESCRIPTION:
+        Name of the cache entry of sigma S. Everything that changes the per
+        sigma measures goes in. The mean density and the max Frobenius norm
+        are functions of the volume (and Crop), so the digest covers them.
+    RETURN:
+        str, hex digest
+    DEBUG:
+    FUTURE:
+    """
+    keyD = {'version' : SIGMA_CACHE_VERSION, 'volume' : Digest, 'sigma' : float(S),
+            'method' : Method, 'dtype' : np.dtype(DType).str, 'nsig' : float(NSig),
+            'chain' : None if ChainL is None else [float(s) for s in ChainL],
+            'factor' : int(Factor), 'masked' : bool(Masked),
+            'crop' : None if Crop is None else [[c.start, c.stop] for c in Crop]}
+    return(hashlib.sha256(json.dumps(keyD, sort_keys=True).encode()).hexdigest())
+
+
+def sigma_cache_path(CacheDir=None, Key=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        Key      : str, from sigma_cache_key()
+    DESCRIPTION:
+        File of a cache entry
+    RETURN:
+        str, path
+    DEBUG:
+    FUTURE:
+    """
+    return(os.path.join(CacheDir, "{}.npz".format(Key)))
+
+
+def load_sigma_measures(CacheDir=None, Key=None, Shape=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        Key      : str, from sigma_cache_key()
+        Shape    : tuple, expected shape of the measures
+    DESCRIPTION:
+        Reads the measures of one sigma. A hit resets the entry's age (mtime),
+        so evict_sigma_cache() removes the least recently used entries first.
+        Unreadable entries (e.g. the disk filled up while writing) are removed
+        and count as a miss.
+    RETURN:
+        (vesselT, clustT), or None if Key isn't cached
+    DEBUG:
+    FUTURE:
+    """
+    path = sigma_cache_path(CacheDir=CacheDir, Key=Key)
+    if(not os.path.isfile(path)):
+        return(None)
+    try:
+        with np.load(path) as npz:
+            vesselT = npz['vessel']
+            clustT  = npz['clust']
+    except Exception:
+        os.remove(path)
+        return(None)
+    if(vesselT.shape != tuple(Shape) or clustT.shape != tuple(Shape)):
+        exit_with_error("ERROR!!! cache entry {} has shape {}, {} expected\n".format(path,
+                        vesselT.shape, Shape))
+    os.utime(path)
+    return(vesselT, clustT)
+
+
+def store_sigma_measures(CacheDir=None, Key=None, VesselT=None, ClustT=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory, created if needed
+        Key      : str, from sigma_cache_key()
+        VesselT, ClustT : numpy arrays, the vesselness and clumpiness of one sigma
+    DESCRIPTION:
+        Writes the measures of one sigma. The file is written under a temporary
+        name and renamed, so concurrent runs sharing CacheDir never see a
+        partial entry.
+    RETURN:
+        N/A
+    DEBUG:
+    FUTURE:
+    """
+    os.makedirs(CacheDir, exist_ok=True)
+    (fd, tmpPath) = tempfile.mkstemp(prefix=".tmp_", suffix=".npz", dir=CacheDir)
+    try:
+        with os.fdopen(fd, "wb") as outFile:
+            np.savez(outFile, vessel=VesselT, clust=ClustT)
+        os.replace(tmpPath, sigma_cache_path(CacheDir=CacheDir, Key=Key))
+    except BaseException:
+        if(os.path.exists(tmpPath)):
+            os.remove(tmpPath)
+        raise
+
+
+def sigma_cache_info(CacheDir=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+    DESCRIPTION:
+        Reports on the state of the cache
+    RETURN:
+        dict with
+            'entries' : int, number of cached sigmas
+            'nbytes'  : int, disk used by them
+            'oldest'  : float, age (s) of the least recently used entry, 0 if empty
+    DEBUG:
+    FUTURE:
+    """
+    fileL = cache_files(CacheDir=CacheDir)
+    now   = time.time()
+    return({'entries' : len(fileL), 'nbytes' : sum([f[2] for f in fileL]),
+            'oldest'  : max([now - f[1] for f in fileL]) if fileL else 0.0})
+
+
+def cache_files(CacheDir=None, Suffix=".npz", Temp=False):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        Suffix   : str, suffix of the entries
+        Temp     : bool, if True list the temporary files (.tmp_*) instead of
+                   the entries
+    DESCRIPTION:
+        Cache entries in CacheDir, or the temporary files they are written to
+        before being renamed. A temporary file may be still being written by
+        another process, so it doesn't count as an entry.
+    RETURN:
+        List of (path, mtime, size), least recently used first
+    DEBUG:
+    FUTURE:
+    """
+    fileL = []
+    if(not os.path.isdir(CacheDir)):
+        return(fileL)
+    for name in os.listdir(CacheDir):
+        if(not name.endswith(Suffix) or name.startswith(".tmp_") != Temp):
+            continue
+        path = os.path.join(CacheDir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:       # Evicted by a concurrent run
+            continue
+        fileL.append((path, stat.st_mtime, stat.st_size))
+    fileL.sort(key=lambda f: f[1])
+    return(fileL)
+
+
+def evict_sigma_cache(CacheDir=None, MaxBytes=SIGMA_CACHE_MAX_BYTES,
+                      MaxAge=SIGMA_CACHE_MAX_AGE):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        MaxBytes : int, size limit of the cache, None for no limit
+        MaxAge   : float, entries not used for MaxAge seconds are removed, None
+                   for no limit
+    DESCRIPTION:
+        Removes the entries older than MaxAge, then the least recently used
+        ones until the cache fits in MaxBytes. Temporary files are left alone
+        (another run may be writing them) unless they are older than
+        CACHE_TMP_MAX_AGE, i.e. left by a killed run.
+    RETURN:
+        (number of files removed, bytes freed)
+    DEBUG:
+    FUTURE:
+    """
+    now    = time.time()
+    fileL  = cache_files(CacheDir=CacheDir)
+    total  = sum([f[2] for f in fileL])
+    nFiles = 0
+    nBytes = 0
+    for (path, mtime, size) in fileL:
+        tooOld = (MaxAge is not None and now - mtime > MaxAge)
+        tooBig = (MaxBytes is not None and total > MaxBytes)
+        if(not tooOld and not tooBig):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total  -= size
+        nFiles += 1
+        nBytes += size
+    for (path, mtime, size) in cache_files(CacheDir=CacheDir, Temp=True):
+        if(now - mtime > CACHE_TMP_MAX_AGE):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            nFiles += 1
+            nBytes += size
+    return(nFiles, nBytes)
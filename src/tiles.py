@@ -0,0 +1,218 @@
+# License: MIT
+# Notes  :
+#
+# Background :
+#
+# Purpose :
+#   Out-of-core versions of the analysis. The volume is processed in slabs along
+#   the first axis (contiguous in memory / on disk for C ordered arrays), each
+#   slab padded with a halo wide enough that the results are the same as for the
+#   whole volume. Results go straight into on-disk (.npy) arrays, so the peak
+#   memory depends on the slab size and not on the volume size.
+#
+# How to Run :
+#   Isn't run directly
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from numpy.lib.format import open_memmap
+from error import exit_with_error
+from gaussian import gaussian_derivative_of_tensor
+from gaussian import gaussian_smooth_tensor
+from hessian import hessian_filter_bank
+from hessian import hessian_eigenvalues
+from hessian import update_shape_measures
+from hessian import scale_space_schedule
+from hessian import hessian_halo
+
+
+def slab_bounds(N=None, SlabSize=None, Halo=None):
+    """
+    ARGS:
+        N        : int, length of the axis being split
+        SlabSize : int, number of elements each slab writes
+        Halo     : int, number of extra elements read on either side of a slab
+    DESCRIPTION:
+        Splits range(N) into slabs. Each slab writes [lo,hi) and reads
+        [rLo,rHi), which is [lo,hi) extended by Halo but clipped to [0,N). At the
+        edges of the volume the clipping gives the same zero padding as the
+        whole volume.
+    RETURN:
+        List of (lo, hi, rLo, rHi)
+    DEBUG:
+    FUTURE:
+    """
+    if(SlabSize < 1):
+        exit_with_error("ERROR!!! SlabSize = {} must be >= 1\n".format(SlabSize))
+    boundL = []
+    for lo in range(0, N, SlabSize):
+        hi = min(lo + SlabSize, N)
+        boundL.append((lo, hi, max(lo - Halo, 0), min(hi + Halo, N)))
+    return(boundL)
+
+
+def tiled_gaussian_derivative_of_tensor(DataT=None, Axis=None, S=None, OutT=None,
+                                        SlabSize=32, Order=1, Method='auto',
+                                        DType=np.float32):
+    """
+    ARGS:
+        DataT   : 3D numpy array (or np.memmap), input data
+        Axis    : int or str, see gaussian_derivative_of_tensor()
+        S       : float, sigma
+        OutT    : 3D numpy array (or np.memmap), same shape as DataT, result is
+                  written here
+        SlabSize: int, number of voxels along the first axis per slab
+        Order, Method, DType : see gaussian_derivative_of_tensor()
+    DESCRIPTION:
+        gaussian_derivative_of_tensor() one slab at a time. Only differentiating
+        along the first axis needs a halo.
+    RETURN:
+        OutT
+    DEBUG:
+        1. Identical to gaussian_derivative_of_tensor() on the whole volume to
+           floating point tolerance, for all 3 axes, Order 1 and 2, fir and fft
+    FUTURE:
+    """
+    if(Method == 'iir'):
+        exit_with_error("ERROR!!! Method = iir has infinite support, it can't be "
+                        "split into slabs exactly\n")
+    halo = Order * int(3 * S) if(Axis == 'x' or Axis == 0) else 0
+    for (lo, hi, rLo, rHi) in slab_bounds(N=DataT.shape[0], SlabSize=SlabSize, Halo=halo):
+        derivT = gaussian_derivative_of_tensor(DataT=np.asarray(DataT[rLo:rHi]), Axis=Axis,
+                                               S=S, Order=Order, Method=Method, DType=DType)
+        OutT[lo:hi] = derivT[lo - rLo : hi - rLo]
+    return(OutT)
+
+
+def slab_eigenvalues(DataT=None, Bound=None, ScheduleL=None, Method='auto',
+                     DType=np.float32):
+    """
+    ARGS:
+        DataT     : 3D numpy array (or np.memmap), the whole input volume
+        Bound     : (lo, hi, rLo, rHi), one slab from slab_bounds()
+        ScheduleL : list, from scale_space_schedule()
+        Method, DType : see extract_local_shape()
+    DESCRIPTION:
+        Reads the slab plus its halo, and for each sigma runs the filter bank and
+        computes the eigenvalues of the interior of the slab (only the interior
+        is exact). This is a generator, so only one sigma's eigenvalues are
+        alive at a time unless the caller keeps them.
+    RETURN:
+        Yields (sIdx, e1T, e2T, e3T, maxFrob) for each sigma, where e*T are the
+        eigenvalues of DataT[lo:hi] and maxFrob is their max Frobenius norm
+    DEBUG:
+    FUTURE:
+    """
+    (lo, hi, rLo, rHi) = Bound
+    smoothT = np.asarray(DataT[rLo:rHi])
+    for (sIdx, blurS, bankS) in ScheduleL:
+        if(blurS > 0):
+            smoothT = gaussian_smooth_tensor(DataT=smoothT, S=blurS, Method=Method,
+                                             DType=DType)
+        hessianL = hessian_filter_bank(DataT=smoothT, S=bankS, Method=Method,
+                                       DType=DType, Verbose=False)
+        hessianL = [h[lo - rLo : hi - rLo] for h in hessianL]
+        (e1T, e2T, e3T, maxFrob) = hessian_eigenvalues(HessianL=hessianL, DType=DType,
+                                                       Verbose=False)
+        del hessianL
+        yield((sIdx, e1T, e2T, e3T, maxFrob))
+
+
+def extract_local_shape_tiled(SigmaL=None, DataT=None, OutStem=None, SlabSize=32,
+                              Method='auto', ScaleSpace=False, DType=np.float32):
+    """
+    ARGS:
+        SigmaL  : List of gaussian scales
+        DataT   : 3D numpy array (or np.memmap), input data
+        OutStem : string, results are written to OutStem_vessel.npy,
+                  OutStem_vSigma.npy, OutStem_clust.npy and OutStem_cSigma.npy
+        SlabSize: int, number of voxels along the first axis per slab
+        Method, ScaleSpace, DType : see extract_local_shape()
+    DESCRIPTION:
+        Same result as extract_local_shape(), computed one slab at a time.
+
+        The vesselness needs the maximum Frobenius norm of each sigma over the
+        whole volume, so there are two passes over the slabs :
+            1. filter bank + eigenvalues for every sigma. The eigenvalues are
+               written to scratch .npy files next to OutStem, and the max
+               Frobenius norm of each sigma is accumulated.
+            2. vesselness / clumpiness from the scratch eigenvalues, written to
+               the output .npy files.
+        Peak memory is ~ 12 * (SlabSize + 2*halo) * ny * nz * DType.itemsize,
+        where halo = hessian_halo(), as long as DataT is an np.memmap. An array
+        in memory is only read a slab at a time, but it is already the size of
+        the volume. dicom_analysis.py --slab decodes a series straight into a
+        .npy (or maps the --volume-cache), and a .npy input is memory mapped,
+        a .pkl input is read in whole. Scratch disk is 3 * len(SigmaL) * the
+        size of the volume, removed at the end.
+    RETURN:
+        vesselT, vSigmaT, clustT, cSigmaT : np.memmap, the .npy files
+    DEBUG:
+        1. Same as extract_local_shape() for slabs of 4, 7 and 32 voxels, with and
+           without ScaleSpace. Sigma maps are identical, the measures agree to
+           float32 round off (max ~1e-5, b/c the fft lengths differ per slab, and
+           the ratios amplify it where e3 is small).
+    FUTURE:
+    """
+    if(Method == 'iir'):
+        exit_with_error("ERROR!!! Method = iir has infinite support, it can't be "
+                        "split into slabs exactly\n")
+    DType = np.dtype(DType)
+    shape = DataT.shape
+    if(len(shape) != 3):
+        exit_with_error("ERROR!!! extract_local_shape_tiled() requires 3D data, "
+                        "{}D given\n".format(len(shape)))
+    halo      = hessian_halo(SigmaL=SigmaL, ScaleSpace=ScaleSpace)
+    boundL    = slab_bounds(N=shape[0], SlabSize=SlabSize, Halo=halo)
+    scheduleL = scale_space_schedule(SigmaL=SigmaL, ScaleSpace=ScaleSpace)
+    outDir    = os.path.dirname(os.path.abspath(OutStem))
+    scratch   = tempfile.mkdtemp(prefix="eigen_", dir=outDir)
+    print("Tiled : {} slabs of {} voxels, halo = {}, scratch = {}".format(len(boundL),
+          SlabSize, halo, scratch))
+    eigenL    = []
+    try:
+        # Eigenvalues of each sigma, on disk
+        eigenL = [open_memmap(os.path.join(scratch, "sigma_{}.npy".format(sIdx)),
+                              mode='w+', dtype=DType, shape=(3,) + shape)
+                  for sIdx in range(len(SigmaL))]
+        frobL  = [0.0] * len(SigmaL)
+        rhoSum = 0.0
+        print("Computing max frobenius norm, eigenvalues, eigenvectors")
+        for (lo, hi, rLo, rHi) in boundL:
+            print("\tSlab {}:{}".format(lo, hi))
+            sys.stdout.flush()
+            rhoSum += np.sum(DataT[lo:hi], dtype=np.float64)
+            for (sIdx, e1T, e2T, e3T, maxFrob) in slab_eigenvalues(DataT=DataT,
+                    Bound=(lo, hi, rLo, rHi), ScheduleL=scheduleL, Method=Method, DType=DType):
+                eigenL[sIdx][0, lo:hi] = e1T
+                eigenL[sIdx][1, lo:hi] = e2T
+                eigenL[sIdx][2, lo:hi] = e3T
+                frobL[sIdx] = max(frobL[sIdx], maxFrob)
+
+        print("Computing vesselness and cluster measures")
+        avgRho  = rhoSum / np.prod(shape)
+        outL    = [open_memmap("{}_{}.npy".format(OutStem, name), mode='w+', dtype=DType,
+                               shape=shape) for name in ['vessel','vSigma','clust','cSigma']]
+        for (lo, hi, rLo, rHi) in boundL:
+            print("\tSlab {}:{}".format(lo, hi))
+            sys.stdout.flush()
+            # Running maxima of the slab
+            tileL  = [np.zeros((hi - lo,) + shape[1:], dtype=DType) for out in outL]
+            dataT  = np.asarray(DataT[lo:hi])
+            # Same order as extract_local_shape(), so ties pick the same sigma
+            for (sIdx, blurS, bankS) in scheduleL:
+                update_shape_measures(E1T=eigenL[sIdx][0, lo:hi], E2T=eigenL[sIdx][1, lo:hi],
+                                      E3T=eigenL[sIdx][2, lo:hi], DataT=dataT, AvgRho=avgRho,
+                                      MaxFrob=frobL[sIdx], S=SigmaL[sIdx], VesselT=tileL[0],
+                                      VSigmaT=tileL[1], ClustT=tileL[2], CSigmaT=tileL[3],
+                                      Verbose=False)
+            for (out, tileT) in zip(outL, tileL):
+                out[lo:hi] = tileT
+        for out in outL:
+            out.flush()
+    finally:
+        del eigenL
+        shutil.rmtree(scratch, ignore_errors=True)
+    return(tuple(outL))
@@ -27,6 +27,9 @@ import pickle
 # my code
 from file_io import read_data
 from error import exit_with_error
+from functions import parse_options
+from gaussian import set_num_threads
+from volume_cache import VOLUME_CACHE_MAX_BYTES
 from random import random
     
 
@@ -43,23 +46,32 @@ def print_help(ExitVal=None):
     FUTURE:
     """
     sys.stdout.write(
-        "\nUSAGE : python src/visualize.py path [series|single] [2D|2Dseg|3D|hist] [plotOpts]\n\n"
+        "\nUSAGE : python src/visualize.py path [series|single] [2D|2Dseg|3D|hist] [plotOpts] [options]\n\n"
         "      path              : string \n"
-        "                           path to pkl file,  DICOM file or a directory of DICOMs\n"
+        "                           path to res, pkl file,  DICOM file or a directory of DICOMs\n"
         "      [series|single]   : string\n"
         "                           if 'series' : path is a directory with a series of DICOM files\n"
-        "                           if 'single' : path is a single DICOM or pkl file\n"
+        "                           if 'single' : path is a single DICOM, res or pkl file\n"
+        "                                         (stem.res:vessel for another map than clust)\n"
         "      [2D|2Dseg|3D|hist]: string, \n"
         "                           2D     - visualize in 2D (using matplotlib)\n"
         "                           2D-seg - visualize in 2D (using matplotlib) and segmentation\n"
         "                           3D     - visualize in 3D (using vtk)\n"
         "                           hist   - histogram of the pixel values\n"
-        "      [plotOpts]        : [clust.pkl] OR [thresh]  \n"
-        "                          [clust.pkl]= string, required when using 2Dseg, segmentation file \n"
+        "      [plotOpts]        : [stem.res] OR [thresh]  \n"
+        "                          [stem.res] = string, required when using 2Dseg, segmentation file \n"
         "                                       generated by dicom_analysis.py\n"
         "                          [thresh]   = string or int, required when using 3D. Can use\n"
         "                                       'otsu' for automatic thresholding\n"
-        "                         \n")
+        "   options :\n"
+        "      --readers N       : threads reading a DICOM series, default the\n"
+        "                          same as --threads\n"
+        "      --threads N       : size of the thread pool (see gaussian.py), default\n"
+        "                          from OMP_NUM_THREADS or the number of cores\n"
+        "      --volume-cache DIR: keep the decoded series in DIR, later runs on\n"
+        "                          the same files memory map it\n"
+        "      --volume-cache-size GB : size limit of the volume cache, default {:g}\n"
+        "                         \n".format(VOLUME_CACHE_MAX_BYTES / 2**30))
     sys.exit(ExitVal)
 
 
@@ -106,11 +118,12 @@ def plot_histogram(Array=None):
 def plot_multiple_dicom(PixelT=None, SegT=None):
     """
     ARGS:
-        PixelT :  3D Numpy array extacted from Dicom file
+        PixelT :  3D Numpy array extacted from Dicom file, or a LazyDicomVolume
         SegT   :  (optional) 3D Numpy array of segmented volume to plot side-by-side 
     DESCRIPTION:
         Plots PixelT as a heat map with slider to sweep through
-        the z-axis
+        the z-axis. Only PixelT[:,:,z] is indexed, so a LazyDicomVolume
+        decodes the slices as the slider reaches them.
     RETURN:
         N/A
     DEBUG:
@@ -333,42 +346,53 @@ def main():
                         "expected\n".format(sys.version_info[0]))
 
     ###### Get Command Line Options ######
-    if(len(sys.argv) != 2 and len(sys.argv) != 4 and len(sys.argv) != 5) :
-        print_help(1)
-    elif(len(sys.argv) == 2 and "-h" in sys.argv[1]):
+    if(len(sys.argv) == 2 and "-h" in sys.argv[1]):
         print_help(0)
-    elif(len(sys.argv) != 4 and len(sys.argv) != 5):
+    argL, optD = parse_options(ArgL=sys.argv, OptD={'--readers' : None,
+                                                   '--threads' : None,
+                                                   '--volume-cache' : None,
+                                                   '--volume-cache-size' : None})
+    if(len(argL) != 4 and len(argL) != 5):
         print_help(1)
+    if(optD['--threads'] is not None):
+        set_num_threads(int(optD['--threads']))
+    readers = int(optD['--readers']) if optD['--readers'] is not None else None
+    volumeCacheSize = VOLUME_CACHE_MAX_BYTES
+    if(optD['--volume-cache-size'] is not None):
+        volumeCacheSize = float(optD['--volume-cache-size']) * 2**30
     ## argv[1]
-    path = sys.argv[1]
+    path = argL[1]
     ## argv[2]
-    if(sys.argv[2].lower() == "series"):
+    if(argL[2].lower() == "series"):
         nFiles = "series"
-    elif(sys.argv[2].lower() == "single"):
+    elif(argL[2].lower() == "single"):
         nFiles = "single"
     else:
         exit_with_error("ERROR!!! {} is invalid value for "
                         "[series|single]\n".format(inputFmt))
     ## argv[3]
-    if(sys.argv[3].upper() == "2D"):
+    if(argL[3].upper() == "2D"):
         visType = "2D"
-    elif(sys.argv[3].upper() == "2DSEG"):
+    elif(argL[3].upper() == "2DSEG"):
         visType = "2DSEG"
-        clustPath = sys.argv[4]
+        clustPath = argL[4]
         clustT = read_data(clustPath, NFiles = "single")
-    elif(sys.argv[3].upper() == "3D"):
+    elif(argL[3].upper() == "3D"):
         visType = "3D"
-        thresh = sys.argv[4].upper()
+        thresh = argL[4].upper()
         try :
             thresh = float(thresh)
         except ValueError :
             thresh = thresh
-    elif(sys.argv[3].upper() == "HIST"):
+    elif(argL[3].upper() == "HIST"):
         visType = "HIST"
     else:
         exit_with_error("ERROR!!! {} is invalid value for "
                         "[2D|3D]\n".format(inputFmt))
-    pixelT = read_data(Path=path, NFiles=nFiles)
+    # The 2D viewers only show one slice at a time, decode them on demand
+    pixelT = read_data(Path=path, NFiles=nFiles, Workers=readers,
+                       Cache=optD['--volume-cache'], CacheSize=volumeCacheSize,
+                       Lazy=(visType == "2D" or visType == "2DSEG"))
     if(visType == "2D"):
         if(len(pixelT.shape) == 2):
             #exit_with_error("ERROR!! This is yet to be implemented")
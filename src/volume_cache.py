@@ -0,0 +1,197 @@
+# License: MIT
+# Notes  :
+#
+# Background :
+#
+# Purpose :
+#   On-disk cache of decoded DICOM series. A series is decoded once into a .npy
+#   file (plus a .json sidecar), later reads memory map it instead of decoding
+#   every slice again. Entries are keyed by a fingerprint of the files (see
+#   series_fingerprint()), so editing, adding or removing a file gives a new
+#   entry. The least recently used entries are removed by evict_volume_cache().
+#
+# How to Run :
+#   Isn't run directly
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+from error import exit_with_error
+from sigma_cache import cache_files
+from sigma_cache import CACHE_TMP_MAX_AGE
+
+VOLUME_CACHE_VERSION   = 1                 # Bump when the decoding changes
+VOLUME_CACHE_MAX_BYTES = 16 * 2**30        # Default size limit, see evict_volume_cache()
+
+
+def series_fingerprint(FileL=None):
+    """
+    ARGS:
+        FileL   : list of strings, the files of a series
+    DESCRIPTION:
+        Hash of the (absolute) name, size and mtime of every file. Only stat()'s
+        the files, so it costs ~ a directory listing, not a read.
+    RETURN:
+        str, hex digest
+    DEBUG:
+    FUTURE:
+    """
+    hashH = hashlib.sha256("volume {}".format(VOLUME_CACHE_VERSION).encode())
+    for fPath in sorted([os.path.abspath(f) for f in FileL]):
+        stat = os.stat(fPath)
+        hashH.update("{}\0{}\0{}\n".format(fPath, stat.st_size, stat.st_mtime_ns).encode())
+    return(hashH.hexdigest())
+
+
+def volume_cache_paths(CacheDir=None, Key=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        Key      : str, from series_fingerprint()
+    DESCRIPTION:
+        Files of a cache entry
+    RETURN:
+        (path of the .npy volume, path of the .json sidecar)
+    DEBUG:
+    FUTURE:
+    """
+    stem = os.path.join(CacheDir, Key)
+    return("{}.npy".format(stem), "{}.json".format(stem))
+
+
+def load_cached_volume(CacheDir=None, Key=None, MetaD=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        Key      : str, from series_fingerprint()
+        MetaD    : dict, if not None, MetaD['spacing'] is set from the sidecar
+    DESCRIPTION:
+        Memory maps a cached volume, nothing is read until it is used. The map
+        is copy on write (mmap_mode='c'), so callers can modify it in memory
+        (e.g. visualize.py clipping negative values) without touching the
+        cache. A hit resets the entry's age for evict_volume_cache().
+    RETURN:
+        np.memmap, or None if Key isn't cached
+    DEBUG:
+    FUTURE:
+    """
+    (npyPath, jsonPath) = volume_cache_paths(CacheDir=CacheDir, Key=Key)
+    # The sidecar is written last, without it the entry is incomplete
+    if(not os.path.isfile(jsonPath) or not os.path.isfile(npyPath)):
+        return(None)
+    with open(jsonPath, "r") as inFile:
+        metaD = json.load(inFile)
+    pixelT = np.load(npyPath, mmap_mode='c')
+    if(list(pixelT.shape) != metaD['shape'] or pixelT.dtype.str != metaD['dtype']):
+        exit_with_error("ERROR!!! cache entry {} is {} {}, its sidecar says {} "
+                        "{}\n".format(npyPath, pixelT.shape, pixelT.dtype.str,
+                        metaD['shape'], metaD['dtype']))
+    os.utime(npyPath)
+    if(MetaD is not None):
+        MetaD['spacing'] = metaD.get('spacing', None)
+    return(pixelT)
+
+
+def read_cached_series(CacheDir=None, FileL=None, ReadFunc=None,
+                       MaxBytes=VOLUME_CACHE_MAX_BYTES, MetaD=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory, created if needed
+        FileL    : list of strings, the files of the series
+        ReadFunc : function, ReadFunc(OutPath=path, MetaD=metaD) decodes the
+                   series into a new .npy file at path and returns it, and sets
+                   metaD['spacing'] (see read_dicom_series())
+        MaxBytes : int, size limit of the cache, see evict_volume_cache()
+        MetaD    : dict, if not None, MetaD['spacing'] is set to the voxel size
+    DESCRIPTION:
+        Returns the cached volume of FileL, decoding it into the cache first
+        if it isn't there. The volume is decoded straight into a temporary
+        .npy in CacheDir and renamed, then the sidecar (file list, shape,
+        type, spacing) is written, so a killed run or a concurrent reader never sees a
+        partial entry.
+    RETURN:
+        np.memmap, the volume
+    DEBUG:
+        1. 300 512x512 int16 slices (150 MB), 4 workers : 1.59 s without the
+           cache, 1.72 s for a miss (decoding into the .npy), 2.5 ms for a hit.
+           Identical volumes, touching a file of the series gives a miss.
+    FUTURE:
+    """
+    key    = series_fingerprint(FileL=FileL)
+    pixelT = load_cached_volume(CacheDir=CacheDir, Key=key, MetaD=MetaD)
+    if(pixelT is not None):
+        print("\tVolume cache : hit {}".format(key[:16]))
+        return(pixelT)
+    print("\tVolume cache : miss {}, decoding".format(key[:16]))
+    os.makedirs(CacheDir, exist_ok=True)
+    (npyPath, jsonPath) = volume_cache_paths(CacheDir=CacheDir, Key=key)
+    (fd, tmpPath) = tempfile.mkstemp(prefix=".tmp_", suffix=".npy", dir=CacheDir)
+    os.close(fd)
+    try:
+        readD  = {}
+        pixelT = ReadFunc(OutPath=tmpPath, MetaD=readD)
+        pixelT.flush()
+        metaD  = {'version' : VOLUME_CACHE_VERSION, 'shape' : list(pixelT.shape),
+                  'dtype' : pixelT.dtype.str, 'files' : list(FileL),
+                  'spacing' : readD.get('spacing', None),
+                  'created' : time.strftime("%Y-%m-%d %H:%M:%S")}
+        del pixelT
+        os.replace(tmpPath, npyPath)
+        (fd, tmpPath) = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=CacheDir)
+        with os.fdopen(fd, "w") as outFile:
+            json.dump(metaD, outFile, indent=1)
+        os.replace(tmpPath, jsonPath)
+    except BaseException:
+        # exit_with_error() raises SystemExit, clean up for it too
+        if(os.path.exists(tmpPath)):
+            os.remove(tmpPath)
+        raise
+    evict_volume_cache(CacheDir=CacheDir, MaxBytes=MaxBytes, Keep=key)
+    return(load_cached_volume(CacheDir=CacheDir, Key=key, MetaD=MetaD))
+
+
+def evict_volume_cache(CacheDir=None, MaxBytes=VOLUME_CACHE_MAX_BYTES, Keep=None):
+    """
+    ARGS:
+        CacheDir : str, cache directory
+        MaxBytes : int, size limit of the cache
+        Keep     : str, key of an entry never evicted (the one just written)
+    DESCRIPTION:
+        Removes the least recently used volumes (and their sidecars) until the
+        cache fits in MaxBytes. Volumes still being decoded (.tmp_*) by
+        another run don't count and aren't removed, unless they are older
+        than CACHE_TMP_MAX_AGE, i.e. left by a killed run.
+    RETURN:
+        (number of volumes removed, bytes freed)
+    DEBUG:
+    FUTURE:
+    """
+    fileL  = cache_files(CacheDir=CacheDir, Suffix=".npy")
+    total  = sum([f[2] for f in fileL])
+    nFiles = 0
+    nBytes = 0
+    keepPath = None if Keep is None else volume_cache_paths(CacheDir=CacheDir, Key=Keep)[0]
+    for (path, mtime, size) in fileL:
+        if(total <= MaxBytes):
+            break
+        if(path == keepPath):
+            continue
+        for fPath in [path, path[:-len(".npy")] + ".json"]:
+            try:
+                os.remove(fPath)
+            except FileNotFoundError:
+                pass
+        total  -= size
+        nFiles += 1
+        nBytes += size
+    now = time.time()
+    for suffix in [".npy", ".json"]:
+        for (path, mtime, size) in cache_files(CacheDir=CacheDir, Suffix=suffix, Temp=True):
+            if(now - mtime > CACHE_TMP_MAX_AGE):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    return(nFiles, nBytes)